@@ -1,5 +1,6 @@
-import gzip
+import io
 import os
+import time
 
 import numpy as np
 import pandas as pd
@@ -45,8 +46,76 @@ RA_CARLIN = "GCGCCGGCGAGCGCTATGAGCGACTATGGAGTCGACACGACTCGCGCATACGATGGAGTCGACTACA
 
 
 def consensus_sequence(df):
-    X = np.array([np.array(bytearray(x, encoding="utf8")) for x in df])
-    return bytes(np.median(X, axis=0).astype("uint8")).decode("utf8")
+    """
+    Consensus of a list of sequences, see batch_consensus_sequences
+    """
+    return batch_consensus_sequences(df, np.zeros(len(df), dtype=int)).iloc[0]
+
+
+_base_to_index = np.full(256, 4, dtype=np.uint8)  # 4: N, or any other character
+_base_to_index[np.frombuffer(b"ACGT", dtype=np.uint8)] = [0, 1, 2, 3]
+_index_to_base = np.frombuffer(b"ACGTN", dtype=np.uint8)
+
+
+def batch_consensus_sequences(seqs, groups, weights=None):
+    """
+    Weighted consensus sequence of each group (e.g., of all CARLIN sequences within a cell),
+    computed for all groups at once.
+
+    The sequences are padded into one uint8 matrix, and the votes of each group are summed with
+    a single bincount over (group, position, base). The consensus length is the weighted majority
+    length of the group (the shortest on ties). Each position then takes the weighted majority base
+    among the sequences that cover it (A, C, G, T, N in this order on ties), so that sequences of
+    different lengths are handled explicitly. Characters other than ACGT count as N.
+
+    seqs:
+        A list/array of sequences
+    groups:
+        The group of each sequence
+    weights:
+        The weight of each sequence, e.g., its read count. Default: 1
+
+    Returns a pd.Series of consensus sequences, indexed by the sorted unique groups.
+    """
+    seqs = np.asarray(seqs).astype(bytes)
+    if weights is None:
+        weights = np.ones(len(seqs))
+    weights = np.asarray(weights, dtype=float)
+    group_codes, group_names = pd.factorize(np.asarray(groups), sort=True)
+    order = np.argsort(group_codes, kind="stable")
+    seqs, weights, group_codes = seqs[order], weights[order], group_codes[order]
+
+    width = seqs.dtype.itemsize
+    # process blocks of groups, to bound the size of the (group, position, base) vote table
+    block_size = max(1, 10 ** 7 // (5 * width + 1))
+    consensus = []
+    for g0 in range(0, len(group_names), block_size):
+        g1 = min(g0 + block_size, len(group_names))
+        r0, r1 = np.searchsorted(group_codes, [g0, g1])
+        X = seqs[r0:r1].view(np.uint8).reshape(r1 - r0, width)
+        g = group_codes[r0:r1] - g0
+        w = weights[r0:r1]
+        G = g1 - g0
+
+        length = (X != 0).sum(1)
+        length_votes = np.bincount(
+            g * (width + 1) + length, weights=w, minlength=G * (width + 1)
+        ).reshape(G, width + 1)
+        consensus_length = np.argmax(length_votes, axis=1)
+
+        rows, cols = np.nonzero(X != 0)
+        base_votes = np.bincount(
+            (g[rows] * width + cols) * 5 + _base_to_index[X[rows, cols]],
+            weights=w[rows],
+            minlength=G * width * 5,
+        ).reshape(G, width, 5)
+        Y = _index_to_base[np.argmax(base_votes, axis=2)]
+        Y[np.arange(width) >= consensus_length[:, np.newaxis]] = 0
+        consensus.append(Y.view(f"S{width}").ravel().astype(str))
+
+    if len(consensus) == 0:
+        return pd.Series([], index=group_names, dtype=object)
+    return pd.Series(np.concatenate(consensus), index=group_names)
 
 def check_editing(df,template):
     if template.startswith("cCARLIN"):
@@ -60,8 +129,15 @@ def check_editing(df,template):
     #     if length> len(CARLIN_seq):
     #         length=len(CARLIN_seq)
     # print(f'Use expected full length for unedited BC: {length}')
-    df['edited']=df['clone_id'].apply(lambda x: not (CARLIN_seq.startswith(x)))
-    editing_efficiency=df.groupby('cell_id').agg({'edited':'mean'}).mean()['edited']
+    # evaluate each unique sequence once, and broadcast back to the reads
+    codes,unique_seqs=pd.factorize(df['clone_id'])
+    edited=np.array([not (CARLIN_seq.startswith(x)) for x in unique_seqs],dtype=bool)
+    df['edited']=edited[codes]
+    if 'cell_id' in df.columns:
+        cell_key='cell_id'
+    else: # packed barcodes, see larry.pack_barcodes
+        cell_key=['library','cell_bc']
+    editing_efficiency=df.groupby(cell_key).agg({'edited':'mean'}).mean()['edited']
     print(f'Editing efficiency: {editing_efficiency:.3f}')
     return df
 
@@ -80,15 +156,363 @@ def CARLIN_analysis(
     )
     df_final = df_tmp[df_tmp["max_read_ratio"] > read_ratio_threshold]
 
-    # obtain consensus sequences
-    df_final = df_final.groupby(cell_bc_key).agg(
-        consensuse_CARLIN=(clone_key, consensus_sequence), read=("read", "sum")
+    # obtain consensus sequences, for all cells at once
+    consensus = batch_consensus_sequences(
+        df_final[clone_key], df_final[cell_bc_key], weights=df_final["read"]
     )
+    df_final = df_final.groupby(cell_bc_key).agg(read=("read", "sum"))
+    df_final.insert(0, "consensuse_CARLIN", consensus.loc[df_final.index].to_numpy())
     df_final["CARLIN_length"] = df_final["consensuse_CARLIN"].apply(lambda x: len(x))
     return df_final
 
 
-def CARLIN_raw_reads(data_path, sample, protocol="scCamellia",fastq_format=0):
+def _CARLIN_analysis_one_partition(df_part, partition, kwargs):
+    """
+    Worker for CARLIN_analysis_across_partitions. Returns the result of one partition and its timing.
+    """
+    t_start = time.perf_counter()
+    df_final = CARLIN_analysis(df_part, **kwargs)
+    report = {
+        "partition": partition,
+        "worker": os.getpid(),
+        "row": len(df_part),
+        "cell": len(df_final),
+        "time": time.perf_counter() - t_start,
+    }
+    return df_final, report
+
+
+def CARLIN_analysis_across_partitions(
+    df_input,
+    cell_bc_key="cell_bc",
+    clone_key="clone_id",
+    read_ratio_threshold=0.6,
+    partition="library",
+    n_partitions=None,
+    n_jobs=4,
+    max_concurrent_partitions=None,
+    executor=None,
+):
+    """
+    Run CARLIN_analysis on partitions of the molecule table in parallel processes.
+    Cells never interact across partitions, so the results are simply concatenated.
+
+    Parameters
+    ----------
+    df_input:
+        The molecule table, e.g., from CARLIN_preprocessing
+    partition:
+        'library': one partition per library, and a 'library' column is added to the output.
+        'hash': n_partitions partitions by a hash of cell_bc_key; the output is the same as CARLIN_analysis.
+    n_partitions:
+        Number of partitions for partition='hash'. Default: 4*n_jobs
+    n_jobs:
+        Number of worker processes, if executor is not provided
+    max_concurrent_partitions:
+        Maximum number of partitions sent to the workers at the same time, to bound the memory.
+        Default: n_jobs
+    executor:
+        See util.map_bounded
+
+    Returns
+    -------
+    df_final:
+        As CARLIN_analysis
+    df_report:
+        Per-partition worker, row number, cell number, time (s) and cells per second
+    """
+
+    if partition == "library":
+        keys = df_input["library"].to_numpy()
+    elif partition == "hash":
+        if n_partitions is None:
+            n_partitions = 4 * n_jobs
+        keys = pd.util.hash_array(df_input[cell_bc_key].to_numpy()) % n_partitions
+    else:
+        raise ValueError("partition should be among {'library', 'hash'}")
+    codes, partition_list = pd.factorize(keys)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(partition_list) + 1))
+
+    # only send the columns needed by CARLIN_analysis
+    df_tmp = df_input[[cell_bc_key, clone_key, "read"]]
+    kwargs = dict(
+        cell_bc_key=cell_bc_key,
+        clone_key=clone_key,
+        read_ratio_threshold=read_ratio_threshold,
+    )
+    args_list = [
+        (df_tmp.iloc[order[bounds[j] : bounds[j + 1]]], partition_list[j], kwargs)
+        for j in range(len(partition_list))
+    ]
+
+    results = util.map_bounded(
+        _CARLIN_analysis_one_partition,
+        args_list,
+        n_jobs=n_jobs,
+        executor=executor,
+        max_concurrent=max_concurrent_partitions,
+    )
+
+    if partition == "library":
+        for df_final, report in results:
+            df_final["library"] = report["partition"]
+        df_final = pd.concat([x[0] for x in results])
+    else:
+        df_final = pd.concat([x[0] for x in results]).sort_index()
+    df_report = pd.DataFrame([x[1] for x in results])
+    df_report["cell_per_second"] = df_report["cell"] / df_report["time"]
+    print(
+        f"Analyzed {df_report['cell'].sum()} cells in {len(df_report)} partitions, "
+        f"{df_report['cell'].sum()/df_report['time'].sum():.1f} cells/s per worker"
+    )
+    return df_final, df_report
+
+
+def _quality_min(quality):
+    """
+    Min phred score of a read segment, as a float (nan for an empty segment), as in _segment_quality
+    """
+    return float(np.min(quality)) if len(quality) > 0 else np.nan
+
+
+def _annotate_sc_reads(df_seq, sample, bc_len, umi_len):
+    """
+    Split the tag read into cell barcode and UMI, and summarize the read quality.
+
+    df_seq: a dataframe with columns 'Tag', 'Seq', 'Tag_quality', 'Seq_quality'
+    """
+    df_seq["cell_bc"] = df_seq["Tag"].apply(lambda x: x[:bc_len])
+    df_seq["cell_bc_quality_mean"] = df_seq["Tag_quality"].apply(
+        lambda x: np.mean(x[:bc_len])
+    )
+    df_seq["cell_bc_quality_min"] = df_seq["Tag_quality"].apply(
+        lambda x: _quality_min(x[:bc_len])
+    )
+    df_seq["library"] = sample
+    cell_id = [
+        f"{x}_{y}" for x, y in zip(df_seq["library"].to_list(), df_seq["cell_bc"].to_list())
+    ]
+    df_seq["cell_id"] = cell_id
+    df_seq["umi"] = df_seq["Tag"].apply(lambda x: x[bc_len : (bc_len + umi_len)])
+    df_seq["umi_quality_mean"] = df_seq["Tag_quality"].apply(
+        lambda x: np.mean(x[bc_len : (bc_len + umi_len)])
+    )
+    df_seq["umi_quality_min"] = df_seq["Tag_quality"].apply(
+        lambda x: _quality_min(x[bc_len : (bc_len + umi_len)])
+    )
+    umi_id = [
+        f"{x}_{y}" for x, y in zip(df_seq["cell_bc"].to_list(), df_seq["umi"].to_list())
+    ]
+    df_seq["umi_id"] = umi_id
+    df_seq["clone_id"] = df_seq["Seq"]
+    df_seq["clone_id_quality_mean"] = df_seq["Seq_quality"].apply(
+        lambda x: np.mean(x)
+    )
+    df_seq["clone_id_quality_min"] = df_seq["Seq_quality"].apply(_quality_min)
+    return df_seq.drop(["Tag", "Seq", "Seq_quality", "Tag_quality"], axis=1)
+
+
+def _annotate_bulk_reads(df_seq, sample, UMI_length):
+    """
+    Split the assembled bulk read into UMI and CARLIN sequence, and summarize the read quality.
+
+    df_seq: a dataframe with columns 'Seq', 'quality'
+    """
+    df_seq["cell_bc"] = df_seq["Seq"].apply(lambda x: x[:UMI_length])
+    df_seq["cell_bc_quality_min"] = df_seq["quality"].apply(
+        lambda x: _quality_min(x[:UMI_length])
+    )
+    df_seq["cell_bc_quality_mean"] = df_seq["quality"].apply(
+        lambda x: np.mean(x[:UMI_length])
+    )
+    df_seq["library"] = sample
+    df_seq["cell_id"] = df_seq["library"] + "_" + df_seq["cell_bc"]
+    df_seq["umi"] = ""
+    df_seq["umi_id"] = df_seq["cell_bc"] + "_" + df_seq["umi"]
+    df_seq["clone_id"] = util.reverse_compliment_array(
+        df_seq["Seq"].str[UMI_length:].to_numpy().astype(bytes)
+    ).astype(str)
+    df_seq["clone_id_quality_min"] = df_seq["quality"].apply(
+        lambda x: _quality_min(x[UMI_length:])
+    )
+    df_seq["clone_id_quality_mean"] = df_seq["quality"].apply(
+        lambda x: np.mean(x[UMI_length:])
+    )
+    return df_seq.drop(["quality", "Seq"], axis=1)
+
+
+def _segment_quality(quality, boundaries):
+    """
+    Mean and min phred score of consecutive segments of each read, computed for a whole batch
+    with a single reduction over a padded uint8 matrix.
+
+    quality:
+        phred+33 quality strings, a fixed-width byte array (see util.read_fastq_batches)
+    boundaries:
+        start position of each segment, e.g., [0, 16, 28] for cell barcode, UMI, and the rest of the read.
+        The last segment extends to the end of each read.
+
+    Returns
+    -------
+    quality_mean, quality_min:
+        (read number, segment number) float64 arrays. An empty segment gets a nan.
+    """
+    Q = quality.view(np.uint8).reshape(len(quality), -1)
+    if Q.shape[1] <= boundaries[-1]:
+        Q = np.pad(Q, ((0, 0), (0, boundaries[-1] + 1 - Q.shape[1])))
+    valid = Q > 0  # b'\x00' pads the reads shorter than the batch width
+    phred = Q - np.uint8(33)
+
+    count = np.add.reduceat(valid, boundaries, axis=1, dtype=np.int64)
+    total = np.add.reduceat(np.where(valid, phred, 0), boundaries, axis=1, dtype=np.int64)
+    quality_min = np.minimum.reduceat(np.where(valid, phred, 255), boundaries, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        quality_mean = total / count
+    # float64 in every batch (and as in the SeqIO path), so that the dtype does not depend
+    # on whether a batch has an empty segment
+    quality_min = np.where(count > 0, quality_min, np.nan)
+    return quality_mean, quality_min
+
+
+def _annotate_sc_batch(batch, sample, bc_len, umi_len, ids=True):
+    """
+    The same as _annotate_sc_reads, but for a batch of byte arrays from util.read_paired_fastq_batches.
+    With ids=False, the derived 'cell_id' and 'umi_id' strings are not built.
+    """
+    tag_mean, tag_min = _segment_quality(batch["tag_quality"], [0, bc_len, bc_len + umi_len])
+    seq_mean, seq_min = _segment_quality(batch["seq_quality"], [0])
+    df_seq = pd.DataFrame(
+        {
+            "cell_bc": util.slice_byte_array(batch["tag"], 0, bc_len).astype(str),
+            "cell_bc_quality_mean": tag_mean[:, 0],
+            "cell_bc_quality_min": tag_min[:, 0],
+            "library": sample,
+        }
+    )
+    if ids:
+        df_seq["cell_id"] = df_seq["library"] + "_" + df_seq["cell_bc"]
+    df_seq["umi"] = util.slice_byte_array(
+        batch["tag"], bc_len, bc_len + umi_len
+    ).astype(str)
+    df_seq["umi_quality_mean"] = tag_mean[:, 1]
+    df_seq["umi_quality_min"] = tag_min[:, 1]
+    if ids:
+        df_seq["umi_id"] = df_seq["cell_bc"] + "_" + df_seq["umi"]
+    df_seq["clone_id"] = batch["seq"].astype(str)
+    df_seq["clone_id_quality_mean"] = seq_mean[:, 0]
+    df_seq["clone_id_quality_min"] = seq_min[:, 0]
+    return df_seq
+
+
+def _annotate_bulk_batch(batch, sample, UMI_length, ids=True):
+    """
+    The same as _annotate_bulk_reads, but for a batch of byte arrays from util.read_fastq_batches.
+    With ids=False, the derived 'cell_id' and 'umi_id' strings are not built.
+    """
+    quality_mean, quality_min = _segment_quality(batch["quality"], [0, UMI_length])
+    seq_width = batch["seq"].dtype.itemsize
+    df_seq = pd.DataFrame(
+        {
+            "cell_bc": util.slice_byte_array(batch["seq"], 0, UMI_length).astype(str),
+            "cell_bc_quality_min": quality_min[:, 0],
+            "cell_bc_quality_mean": quality_mean[:, 0],
+            "library": sample,
+        }
+    )
+    if ids:
+        df_seq["cell_id"] = df_seq["library"] + "_" + df_seq["cell_bc"]
+    df_seq["umi"] = ""
+    if ids:
+        df_seq["umi_id"] = df_seq["cell_bc"] + "_" + df_seq["umi"]
+    df_seq["clone_id"] = util.reverse_compliment_array(
+        util.slice_byte_array(batch["seq"], UMI_length, max(seq_width, UMI_length + 1))
+    ).astype(str)
+    df_seq["clone_id_quality_min"] = quality_min[:, 1]
+    df_seq["clone_id_quality_mean"] = quality_mean[:, 1]
+    return df_seq
+
+
+def _aggregate_molecules(df_list):
+    """
+    Collapse read tables (or partially collapsed molecule tables) into one row per
+    molecule (cell_bc, umi, clone_id). Reads are summed, '*_quality_sum' columns are
+    summed, and '*_quality_min' columns take the minimum.
+    """
+    df = pd.concat(df_list, ignore_index=True)
+    agg_dict = {"read": ("read", "sum")}
+    for key in df.columns:
+        if key.endswith("_quality_sum"):
+            agg_dict[key] = (key, "sum")
+        elif key.endswith("_quality_min"):
+            agg_dict[key] = (key, "min")
+    return (
+        df.groupby(["cell_bc", "umi", "clone_id"], sort=False)
+        .agg(**agg_dict)
+        .reset_index()
+    )
+
+
+def _combine_batches(df_batches, sample, aggregate=False, packed=False):
+    """
+    Concatenate the annotated read batches, or, with aggregate=True, count the molecules
+    (cell_bc, umi, clone_id) while streaming, so that the memory scales with the number of
+    unique molecules instead of raw reads.
+
+    Each batch is first collapsed on its own. The collapsed batches are kept in a pending list,
+    and merged into the molecule table once they outgrow it.
+    With packed=True, the barcodes are integers from larry.pack_barcodes, and the
+    'cell_id' and 'umi_id' strings are not built.
+    """
+    if not aggregate:
+        return pd.concat(list(df_batches), ignore_index=True)
+
+    quality_keys = []
+    df_molecule = None
+    pending_list = []
+    for df_seq in df_batches:
+        quality_keys = [x[:-5] for x in df_seq.columns if x.endswith("_quality_mean")]
+        df_seq = df_seq.filter(
+            ["cell_bc", "umi", "clone_id"]
+            + [f"{x}_mean" for x in quality_keys]
+            + [f"{x}_min" for x in quality_keys]
+        ).rename(columns={f"{x}_mean": f"{x}_sum" for x in quality_keys})
+        df_seq["read"] = 1
+        pending_list.append(_aggregate_molecules([df_seq]))
+
+        pending_N = np.sum([len(x) for x in pending_list])
+        if (df_molecule is None) or (pending_N > len(df_molecule)):
+            if df_molecule is not None:
+                pending_list = [df_molecule] + pending_list
+            df_molecule = _aggregate_molecules(pending_list)
+            pending_list = []
+
+    if df_molecule is None:
+        raise ValueError(f"No reads found for {sample}")
+    if len(pending_list) > 0:
+        df_molecule = _aggregate_molecules([df_molecule] + pending_list)
+
+    df_molecule["library"] = sample
+    if not packed:
+        df_molecule["cell_id"] = df_molecule["library"] + "_" + df_molecule["cell_bc"]
+        df_molecule["umi_id"] = df_molecule["cell_bc"] + "_" + df_molecule["umi"]
+    for x in quality_keys:
+        df_molecule[f"{x}_mean"] = df_molecule[f"{x}_sum"] / df_molecule["read"]
+    return df_molecule.filter(
+        ["cell_bc", "library", "cell_id", "umi", "umi_id", "clone_id", "read"]
+        + [f"{x}_{y}" for x in quality_keys for y in ["mean", "min"]]
+    )
+
+
+def CARLIN_raw_reads(
+    data_path,
+    sample,
+    protocol="scCamellia",
+    fastq_format=0,
+    batch_size=None,
+    aggregate=False,
+    packed=False,
+):
     """
     Load raw fastq files. This function will depend on what protocol is used.
 
@@ -96,11 +520,32 @@ def CARLIN_raw_reads(data_path, sample, protocol="scCamellia",fastq_format=0):
         file_name=f"{data_path}/{sample}_{Rx}.fastq.gz"
     else:
         file_name=f"{data_path}/{sample}_L001_{Rx}_001.fastq.gz"
+
+    batch_size:
+        If provided, stream the fastq files in batches of this many reads (see util.read_fastq_batches),
+        and annotate each batch before loading the next one. The peak memory then depends on batch_size,
+        instead of the size of the run. Quality is summarized per batch from a padded uint8 matrix,
+        and then dropped. For Bulk protocols, the uncompressed fastq is memory-mapped
+        (see util.read_fastq_mmap). Default: None, parse the whole file with Bio.SeqIO.
+    aggregate:
+        If True, count the reads of each molecule (cell_bc, umi, clone_id) while streaming,
+        and return the deduplicated molecule table, with a 'read' column and read-averaged
+        (for *_quality_mean) or minimum (for *_quality_min) quality per molecule.
+        The memory then scales with unique molecules. This output can be passed to
+        CARLIN_preprocessing directly. It implies batch_size=1000000 if batch_size is None.
+    packed:
+        If True, store cell_bc and umi as 2-bit packed integers (see larry.pack_barcodes),
+        without building the 'cell_id' and 'umi_id' strings. This cuts the memory of these columns several fold,
+        and speeds up grouping. CARLIN_preprocessing and larry.denoise_clonal_data accept the packed table;
+        decode with larry.unpack_barcodes. It implies batch_size=1000000 if batch_size is None.
     """
     # supported_protocol = ["scCamellia", "sc10xV3"]
     # if not (protocol in supported_protocol):
     #     raise ValueError(f"Only support protocols: {supported_protocol}")
 
+    if (aggregate or packed) and (batch_size is None):
+        batch_size = 1000000
+
     if protocol.startswith("sc"):
         if protocol == "scCamellia":
             bc_len = 8
@@ -115,17 +560,30 @@ def CARLIN_raw_reads(data_path, sample, protocol="scCamellia",fastq_format=0):
         else:
             raise ValueError(f"{protocol} must be among scCamellia, sc10xV3")
 
-        seq_list = []
-        seq_quality = []
-
         def get_file_name(Rx):
             if fastq_format==0:
                 file_name=f"{data_path}/{sample}_{Rx}.fastq.gz"
             else:
                 file_name=f"{data_path}/{sample}_L001_{Rx}_001.fastq.gz"
             return file_name
-        
-        with gzip.open(get_file_name(seq_read), "rt") as handle:
+
+        if batch_size is not None:
+            batches = util.read_paired_fastq_batches(
+                get_file_name(seq_read), get_file_name(tag_read), batch_size
+            )
+            df_batches = (
+                _annotate_sc_batch(batch, sample, bc_len, umi_len, ids=not packed)
+                for batch in tqdm(batches)
+            )
+            if packed:
+                df_batches = (larry.pack_barcodes(df) for df in df_batches)
+            return _combine_batches(
+                df_batches, sample, aggregate=aggregate, packed=packed
+            )
+
+        seq_list = []
+        seq_quality = []
+        with io.TextIOWrapper(util.open_fastq(get_file_name(seq_read))) as handle:
             for record in tqdm(SeqIO.parse(handle, "fastq")):
                 seq_list.append(str(record.seq))
                 quality_tmp = record.letter_annotations["phred_quality"]
@@ -133,7 +591,7 @@ def CARLIN_raw_reads(data_path, sample, protocol="scCamellia",fastq_format=0):
 
         tag_list = []
         tag_quality = []
-        with gzip.open(get_file_name(tag_read), "rt") as handle:
+        with io.TextIOWrapper(util.open_fastq(get_file_name(tag_read))) as handle:
             for record in tqdm(SeqIO.parse(handle, "fastq")):
                 tag_list.append(str(record.seq))
                 quality_tmp = record.letter_annotations["phred_quality"]
@@ -147,37 +605,7 @@ def CARLIN_raw_reads(data_path, sample, protocol="scCamellia",fastq_format=0):
                 "Tag_quality": tag_quality,
             }
         )
-        df_seq["cell_bc"] = df_seq["Tag"].apply(lambda x: x[:bc_len])
-        df_seq["cell_bc_quality_mean"] = df_seq["Tag_quality"].apply(
-            lambda x: np.mean(x[:bc_len])
-        )
-        df_seq["cell_bc_quality_min"] = df_seq["Tag_quality"].apply(
-            lambda x: np.min(x[:bc_len])
-        )
-        df_seq["library"] = sample
-        cell_id = [
-            f"{x}_{y}" for x, y in zip(df_seq["library"].to_list(), df_seq["cell_bc"].to_list())
-        ]
-        df_seq["cell_id"] = cell_id
-        df_seq["umi"] = df_seq["Tag"].apply(lambda x: x[bc_len : (bc_len + umi_len)])
-        df_seq["umi_quality_mean"] = df_seq["Tag_quality"].apply(
-            lambda x: np.mean(x[bc_len : (bc_len + umi_len)])
-        )
-        df_seq["umi_quality_min"] = df_seq["Tag_quality"].apply(
-            lambda x: np.min(x[bc_len : (bc_len + umi_len)])
-        )
-        umi_id = [
-            f"{x}_{y}" for x, y in zip(df_seq["cell_bc"].to_list(), df_seq["umi"].to_list())
-        ]
-        df_seq["umi_id"] = umi_id
-        df_seq["clone_id"] = df_seq["Seq"]
-        df_seq["clone_id_quality_mean"] = df_seq["Seq_quality"].apply(
-            lambda x: np.mean(x)
-        )
-        df_seq["clone_id_quality_min"] = df_seq["Seq_quality"].apply(
-            lambda x: np.min(x)
-        )
-        df_seq = df_seq.drop(["Tag", "Seq", "Seq_quality", "Tag_quality"], axis=1)
+        df_seq = _annotate_sc_reads(df_seq, sample, bc_len, umi_len)
 
     elif protocol.startswith("Bulk"):
         if "UMI" in protocol:
@@ -185,48 +613,272 @@ def CARLIN_raw_reads(data_path, sample, protocol="scCamellia",fastq_format=0):
         else:
             UMI_length = 12
 
+        handle = f"{data_path}/{sample}.trimmed.pear.assembled.fastq"
+        if batch_size is not None:
+            df_batches = (
+                _annotate_bulk_batch(
+                    util.gather_fastq_window(window), sample, UMI_length, ids=not packed
+                )
+                for window in tqdm(util.read_fastq_mmap(handle, batch_size))
+            )
+            if packed:
+                df_batches = (larry.pack_barcodes(df) for df in df_batches)
+            return _combine_batches(
+                df_batches, sample, aggregate=aggregate, packed=packed
+            )
+
         seq_list = []
         quality = []
-        handle = f"{data_path}/{sample}.trimmed.pear.assembled.fastq"
         for record in SeqIO.parse(handle, "fastq"):
             seq_list.append(str(record.seq))
             quality_tmp = record.letter_annotations["phred_quality"]
             quality.append(quality_tmp)
 
         df_seq = pd.DataFrame({"quality": quality, "Seq": seq_list})
-        df_seq["cell_bc"] = df_seq["Seq"].apply(lambda x: x[:UMI_length])
-        df_seq["cell_bc_quality_min"] = df_seq["quality"].apply(
-            lambda x: np.min(x[:UMI_length])
-        )
-        df_seq["cell_bc_quality_mean"] = df_seq["quality"].apply(
-            lambda x: np.mean(x[:UMI_length])
-        )
-        df_seq["library"] = sample
-        df_seq["cell_id"] = df_seq["library"] + "_" + df_seq["cell_bc"]
-        df_seq["umi"] = ""
-        df_seq["umi_id"] = df_seq["cell_bc"] + "_" + df_seq["umi"]
-        df_seq["clone_id"] = df_seq["Seq"].apply(
-            lambda x: util.reverse_compliment(x[UMI_length:])
-        )
-        df_seq["clone_id_quality_min"] = df_seq["quality"].apply(
-            lambda x: np.min(x[UMI_length:])
-        )
-        df_seq["clone_id_quality_mean"] = df_seq["quality"].apply(
-            lambda x: np.mean(x[UMI_length:])
-        )
-        df_seq = df_seq.drop(["quality", "Seq"], axis=1)
+        df_seq = _annotate_bulk_reads(df_seq, sample, UMI_length)
     else:
         raise ValueError("un supported cfg")
 
     return df_seq
 
 
+def _load_raw_reads_one_sample(data_path, sample, method, kwargs):
+    """
+    Worker for load_raw_reads_across_samples. Returns the table of one sample and its timing.
+    """
+    t_start = time.perf_counter()
+    if method == "CARLIN":
+        df_sample = CARLIN_raw_reads(data_path, sample, **kwargs)
+    else:
+        df_sample = larry.generate_LARRY_read_count_table(data_path, [sample], **kwargs)
+    if "read" in df_sample.columns:
+        read_N = df_sample["read"].sum()
+    else:
+        read_N = len(df_sample)
+    report = {
+        "sample": sample,
+        "read": read_N,
+        "row": len(df_sample),
+        "time": time.perf_counter() - t_start,
+    }
+    return df_sample, report
+
+
+def load_raw_reads_across_samples(
+    data_path,
+    SampleList,
+    method="CARLIN",
+    n_jobs=4,
+    max_concurrent_samples=None,
+    executor=None,
+    **kwargs,
+):
+    """
+    Load the raw reads of many libraries in parallel processes.
+
+    Parameters
+    ----------
+    data_path:
+        Folder of the fastq files
+    SampleList:
+        Samples to load, e.g., from get_SampleList
+    method:
+        'CARLIN' (CARLIN_raw_reads) or 'LARRY' (larry.generate_LARRY_read_count_table)
+    n_jobs:
+        Number of worker processes, if executor is not provided
+    max_concurrent_samples:
+        Maximum number of samples loaded at the same time, to keep the memory within budget.
+        Default: n_jobs
+    executor:
+        See util.map_bounded
+    kwargs:
+        Passed to the loading function, e.g., protocol='sc10xV3', batch_size=1000000, aggregate=True
+
+    Returns
+    -------
+    df_all:
+        The concatenated table, in the order of SampleList
+    df_report:
+        Per-sample read number, row number, and loading time (s)
+    """
+
+    if method not in ["CARLIN", "LARRY"]:
+        raise ValueError("method should be among {'CARLIN', 'LARRY'}")
+
+    results = util.map_bounded(
+        _load_raw_reads_one_sample,
+        [(data_path, sample, method, kwargs) for sample in SampleList],
+        n_jobs=n_jobs,
+        executor=executor,
+        max_concurrent=max_concurrent_samples,
+    )
+
+    df_all = pd.concat([x[0] for x in results], ignore_index=True)
+    df_report = pd.DataFrame([x[1] for x in results])
+    df_report["read_per_second"] = df_report["read"] / df_report["time"]
+    print(
+        f"Loaded {len(df_report)} samples, {df_report['read'].sum()} reads in total"
+    )
+    return df_all, df_report
+
+
+def _extract_CARLIN_batch(
+    seqs,
+    seq_5prime,
+    seq_3prime_0,
+    appendix,
+    seq_full,
+    seq_3prime_upper_N,
+    seq_5prime_max_edits=0,
+    seq_3prime_max_edits=0,
+):
+    """
+    Validate the primers and cut out the CARLIN sequence for a batch of reads at once.
+
+    seqs is a fixed-width byte array. For each read, this reproduces
+        Valid_5prime: seq_5prime in x
+        Valid_3prime_0: seq_3prime_0 in x
+        Valid_3prime_1: x[-seq_3prime_upper_N:] in seq_full
+        clone_id: x.split(seq_5prime)[1].split(seq_3prime_0)[0]+appendix if Valid_3prime_0,
+            else x.split(seq_5prime)[1]
+    with the primer positions found by np.char.find, and the slicing done on the byte matrix.
+    clone_id is only meaningful for reads with a valid 5 prime.
+
+    Reads without an exact primer match are searched again with util.approximate_search,
+    allowing up to seq_5prime_max_edits (or seq_3prime_max_edits) mismatches and indels.
+    The CARLIN sequence then starts after the best 5 prime match (the rightmost end among ties),
+    and ends before the best 3 prime match downstream (the leftmost start among ties).
+    These reads are flagged in 'Recovered'.
+    """
+    seq_5prime = seq_5prime.encode()
+    seq_3prime_0 = seq_3prime_0.encode()
+    length = np.char.str_len(seqs)
+
+    pos_5prime = np.char.find(seqs, seq_5prime)
+    valid_5prime = pos_5prime >= 0
+    valid_3prime_0 = np.char.find(seqs, seq_3prime_0) >= 0
+
+    # x[-N:] in seq_full, by looking up the read tails among the substrings of seq_full
+    tail_start = np.maximum(length - seq_3prime_upper_N, 0)
+    tails = util.slice_byte_array(seqs, tail_start, length)
+    tail_length = length - tail_start
+    valid_3prime_1 = np.zeros(len(seqs), dtype=bool)
+    for L in np.unique(tail_length):
+        idx = tail_length == L
+        substrings = [seq_full[j : j + L] for j in range(len(seq_full) - L + 1)]
+        valid_3prime_1[idx] = np.isin(tails[idx], np.array(substrings, dtype=bytes))
+
+    # split(seq_5prime)[1] ends at the next seq_5prime, and split(seq_3prime_0)[0] at the first seq_3prime_0 after it
+    start = np.where(valid_5prime, pos_5prime + len(seq_5prime), 0)
+    recovered = np.zeros(len(seqs), dtype=bool)
+    if seq_5prime_max_edits > 0:
+        idx = np.nonzero(~valid_5prime)[0]
+        # prefer the rightmost end, so that a mutated last base stays in the primer
+        distance, position = util.approximate_search(seqs[idx], seq_5prime, prefer="right")
+        idx, position = idx[distance <= seq_5prime_max_edits], position[distance <= seq_5prime_max_edits]
+        valid_5prime[idx] = True
+        recovered[idx] = True
+        start[idx] = position
+
+    stop_1 = np.char.find(seqs, seq_5prime, start)
+    stop_1 = np.where(stop_1 >= 0, stop_1, length)
+    stop_0 = np.char.find(seqs, seq_3prime_0, start, stop_1)
+    stop = np.where(valid_3prime_0 & (stop_0 >= 0), stop_0, stop_1)
+    if seq_3prime_max_edits > 0:
+        # reads already validated by their end (x[-seq_3prime_upper_N:] in seq_full) are kept as they are
+        idx = np.nonzero(valid_5prime & ~valid_3prime_0 & ~valid_3prime_1)[0]
+        distance, position = util.approximate_search(
+            seqs[idx], seq_3prime_0, start=start[idx], from_end=True
+        )
+        idx, position = idx[distance <= seq_3prime_max_edits], position[distance <= seq_3prime_max_edits]
+        valid_3prime_0[idx] = True
+        recovered[idx] = True
+        stop[idx] = position
+    clone_id = util.slice_byte_array(seqs, start, np.maximum(stop, start)).astype(str)
+    if len(appendix) > 0:
+        clone_id = np.where(valid_3prime_0, np.char.add(clone_id, appendix), clone_id)
+
+    return {
+        "Valid_5prime": valid_5prime,
+        "Valid_3prime_0": valid_3prime_0,
+        "Valid_3prime_1": valid_3prime_1,
+        "clone_id": clone_id,
+        "Recovered": recovered,
+    }
+
+
+def extract_CARLIN_sequences(
+    seqs,
+    seq_5prime,
+    seq_3prime_0,
+    appendix,
+    seq_full,
+    seq_3prime_upper_N,
+    seq_5prime_max_edits=0,
+    seq_3prime_max_edits=0,
+    batch_size=1000000,
+):
+    """
+    Validate the primers and extract the CARLIN sequences of all reads in one pass,
+    in batches of batch_size reads (see _extract_CARLIN_batch).
+
+    Returns a dataframe with the columns Valid_5prime, Valid_3prime_0, Valid_3prime_1, clone_id
+    and Recovered (valid only through approximate primer matching), aligned with seqs.
+    """
+    seqs = np.asarray(seqs).astype(bytes)
+    results = [
+        _extract_CARLIN_batch(
+            seqs[j : j + batch_size],
+            seq_5prime,
+            seq_3prime_0,
+            appendix,
+            seq_full,
+            seq_3prime_upper_N,
+            seq_5prime_max_edits,
+            seq_3prime_max_edits,
+        )
+        for j in range(0, len(seqs), batch_size)
+    ]
+    keys = ["Valid_5prime", "Valid_3prime_0", "Valid_3prime_1", "clone_id", "Recovered"]
+    if len(results) == 0:
+        return pd.DataFrame({key: [] for key in keys})
+    return pd.DataFrame({key: np.concatenate([x[key] for x in results]) for key in keys})
+
+
+def _group_molecules(df_output):
+    """
+    One row per molecule (cell, umi, clone_id) and 3prime_detected, in the order of first appearance,
+    with 'read' summed over the molecule. Each key is factorized once, and combined into an integer
+    molecule code, instead of concatenating the keys into one string.
+    """
+    if "cell_id" in df_output.columns:
+        molecule_keys = ["cell_id", "umi", "clone_id"]
+    else:  # packed barcodes
+        molecule_keys = ["library", "cell_bc", "umi", "clone_id"]
+    molecule_id = np.zeros(len(df_output), dtype=np.int64)
+    for key in molecule_keys:
+        codes, uniques = pd.factorize(df_output[key])
+        molecule_id = pd.factorize(molecule_id * len(uniques) + codes)[0]
+    row_id = molecule_id * 2 + df_output["3prime_detected"].to_numpy().astype(np.int64)
+    first_idx = np.sort(np.unique(row_id, return_index=True)[1])
+    read = np.bincount(molecule_id, weights=df_output["read"].to_numpy())
+
+    df_output = df_output.iloc[first_idx].filter(
+        ["cell_bc", "library", "cell_id", "umi", "umi_id", "clone_id", "3prime_detected"]
+    )
+    df_output["read"] = read[molecule_id[first_idx]].astype(np.int64)
+    return df_output.reset_index(drop=True)
+
+
 def CARLIN_preprocessing(
     df_input,
     template="cCARLIN",
     ref_cell_barcodes=None,
     seq_5prime_upper_N=None,
     seq_3prime_upper_N=None,
+    collapse_sequences=True,
+    seq_5prime_max_edits=0,
+    seq_3prime_max_edits=0,
 ):
     """
     Filter the raw reads. This pipeline should be independent of whether this is bulk or single-cell CARLIN
@@ -234,15 +886,26 @@ def CARLIN_preprocessing(
     Parameters
     ----------
     df_input: pd.DataFrame
-        input data, from CARLIN_raw_reads
+        input data, from CARLIN_raw_reads. If it has a 'read' column (e.g., CARLIN_raw_reads with aggregate=True),
+        each row is weighted by its read count.
     template: str
         {'cCARLIN','Tigre','Rosa'}
     ref_cell_barcodes:
-        Reference cell barcode list, for filtering
+        Reference cell barcode list, for filtering. It is packed automatically if
+        cell_bc is packed (see larry.pack_barcodes).
     seq_5prime_upper_N:
         Control the number of 5prime bps for QC. Default: use all bps.
     seq_3prime_upper_N:
         Control the number of 5prime bps for QC. Default: use all bps.
+    collapse_sequences:
+        If True, run the primer checks and the CARLIN extraction once per unique sequence,
+        and broadcast the results back to the reads. Most reads share a sequence,
+        so this saves most of the string work. The output is the same.
+    seq_5prime_max_edits:
+        Number of mismatches/indels allowed in the 5prime primer, for reads without an exact match
+        (see util.approximate_search). Default: 0, exact match only.
+    seq_3prime_max_edits:
+        Number of mismatches/indels allowed in the 3prime primer (of seq_3prime_upper_N bps). Default: 0.
 
     Returns
     -------
@@ -258,7 +921,9 @@ def CARLIN_preprocessing(
     #     The beginning of the 3' end sequences mark the end of CARLIN sequences.
 
     df_output = df_input.copy()
-    tot_fastq_N = len(df_output)
+    if "read" not in df_output.columns:
+        df_output["read"] = 1  # each row is a raw read
+    tot_fastq_N = df_output["read"].sum()
     print("Total fastq:", tot_fastq_N)
     seq_length = int(df_output['clone_id'].iloc[:100].apply(lambda x: len(x)).mean())
     if seq_length<300:
@@ -310,80 +975,158 @@ def CARLIN_preprocessing(
         seq_3prime_upper_N=len(seq_3prime)
 
     seq_3prime_0 = seq_3prime[:seq_3prime_upper_N]
-    df_output["Valid_5prime"] = df_output["clone_id"].apply(
-        lambda x: (seq_5prime in x) 
-    )
-    df_output["Valid_3prime_0"] = df_output["clone_id"].apply(
-        lambda x: (seq_3prime_0 in x) 
-    )
+    if collapse_sequences:
+        codes, seqs = pd.factorize(df_output["clone_id"])
+    else:
+        codes, seqs = np.arange(len(df_output)), df_output["clone_id"].to_numpy()
+    df_extract = extract_CARLIN_sequences(
+        np.asarray(seqs),
+        seq_5prime,
+        seq_3prime_0,
+        appendix,
+        seq_full,
+        seq_3prime_upper_N,
+        seq_5prime_max_edits,
+        seq_3prime_max_edits,
+    ).iloc[codes]
+    df_output["Valid_5prime"] = df_extract["Valid_5prime"].to_numpy()
+    df_output["Valid_3prime_0"] = df_extract["Valid_3prime_0"].to_numpy()
+    df_output["CARLIN"] = df_extract["clone_id"].to_numpy()
     if seq_length<len(seq_full): # insufficient sequencing length
         print(f'Fastq length insufficient ({seq_length} bp)')
         #print('Expected full seq',seq_full)
-        df_output["Valid_3prime_1"] = df_output["clone_id"].apply(
-            lambda x:  x[-seq_3prime_upper_N:] in seq_full
-        )
+        df_output["Valid_3prime_1"] = df_extract["Valid_3prime_1"].to_numpy()
         df_output["Valid_3prime"] = df_output["Valid_3prime_0"] | df_output["Valid_3prime_1"]
     else:
         df_output["Valid_3prime"] = df_output["Valid_3prime_0"]
     
     df_output["Valid"]=df_output["Valid_5prime"] & df_output["Valid_3prime"] 
     print(
-        f"Fastq frac. with vaid 5 prime: {np.mean(df_output['Valid_5prime']):.3f}"
+        f"Fastq frac. with vaid 5 prime: {np.average(df_output['Valid_5prime'], weights=df_output['read']):.3f}"
     )
     print(
-        f"Fastq frac. with vaid 3 prime: {np.mean(df_output['Valid_3prime']):.3f}"
+        f"Fastq frac. with vaid 3 prime: {np.average(df_output['Valid_3prime'], weights=df_output['read']):.3f}"
     )
+    if (seq_5prime_max_edits > 0) or (seq_3prime_max_edits > 0):
+        recovered_N = df_output["read"][
+            df_output["Valid"] & df_extract["Recovered"].to_numpy()
+        ].sum()
+        print(
+            f"Fastq recovered by approximate primer matching: {recovered_N} ({recovered_N/tot_fastq_N:.3f})"
+        )
 
     df_output = df_output.query("Valid==True")
     if ref_cell_barcodes is not None:
+        if pd.api.types.is_integer_dtype(df_output["cell_bc"]):
+            ref_cell_barcodes = util.encode_2bit(np.asarray(ref_cell_barcodes).astype(bytes))
         df_output = df_output[df_output["cell_bc"].isin(ref_cell_barcodes)]
-        valid_BC_N = len(df_output)
+        valid_BC_N = df_output["read"].sum()
         print(f"Fastq with valid barcodes: {valid_BC_N} ({valid_BC_N/tot_fastq_N:.3f})")
     
-    df_output_0=df_output[df_output["Valid_3prime_0"]]
-    df_output_0["clone_id"] = df_output_0["clone_id"].apply(
-        lambda x: x.split(seq_5prime)[1].split(seq_3prime_0)[0]+appendix
-    )
-    df_output_0["3prime_detected"]=True
-    if seq_length<len(seq_full): # insufficient sequencing length
-        df_output_1=df_output[df_output["Valid_3prime_1"] & (~df_output["Valid_3prime_0"])]
-        df_output_1["clone_id"] = df_output_1["clone_id"].apply(
-            lambda x: x.split(seq_5prime)[1]
-        )
-        df_output_1["3prime_detected"]= False
-        df_output=pd.concat([df_output_0,df_output_1])
-    else: # sufficient sequencing length
-        df_output=df_output_0
+    # reads with the 3 prime end detected first, then those only validated by the read end
+    df_output["clone_id"] = df_output["CARLIN"]
+    df_output["3prime_detected"] = df_output["Valid_3prime_0"]
+    df_output = pd.concat(
+        [df_output[df_output["3prime_detected"]], df_output[~df_output["3prime_detected"]]]
+    ).drop("CARLIN", axis=1)
     print(
-        f"Fastq frac. with vaid 3 and 5 prime: {len(df_output)/tot_fastq_N:.3f}"
+        f"Fastq frac. with vaid 3 and 5 prime: {df_output['read'].sum()/tot_fastq_N:.3f}"
     )
     #print(pd.isna(df_output['clone_id']).sum())
     df_output=check_editing(df_output,template)
 
-    df_output["unique_id"] = (
-        df_output["cell_id"] + "_" + df_output["umi_id"] + "_" + df_output["clone_id"]
-    )
-    df_tmp = (
-        df_output.groupby("unique_id").agg(read=("unique_id", "count")).reset_index()
-    )
-    return (
-        df_output.filter(
-            [
-                "cell_bc",
-                "library",
-                "cell_id",
-                "umi",
-                "umi_id",
-                "clone_id",
-                "unique_id",
-                "Valid",
-                "3prime_detected",
-            ]
-        )
-        .merge(df_tmp, on="unique_id")
-        .drop(["Valid", "unique_id"], axis=1)
-        .drop_duplicates()
-    )
+    return _group_molecules(df_output)
+
+
+def assign_CARLIN_locus(
+    seqs, templates=["cCARLIN", "Tigre", "Rosa"], anchor_length=12, batch_size=100000
+):
+    """
+    Assign each read to a CARLIN locus, matching the 5' and 3' primers of all loci in one pass.
+
+    The anchors are the last anchor_length bps of each 5' primer and the first anchor_length bps
+    of each 3' primer. All k-mers of a batch of reads are encoded at once (util.kmer_codes), and
+    looked up among the sorted anchor codes. A read goes to the only locus whose 5' anchor it
+    contains; if several loci match, the 3' anchor breaks the tie.
+
+    Returns an array of template names, with '' for unassignable reads.
+    """
+    primers = {
+        "cCARLIN": (CA_5prime, CA_3prime),
+        "Tigre": (TA_5prime, TA_3prime),
+        "Rosa": (RA_5prime, RA_3prime),
+    }
+    anchors = []
+    for template in templates:
+        seq_5prime, seq_3prime = primers[template]
+        anchors.append(seq_5prime[-anchor_length:])
+        anchors.append(seq_3prime[:anchor_length])
+    anchor_codes = util.kmer_codes(anchors, anchor_length)[:, 0]
+    if len(np.unique(anchor_codes)) < len(anchors):
+        raise ValueError("The primer anchors are not unique. Increase anchor_length")
+    order = np.argsort(anchor_codes)
+    sorted_codes = anchor_codes[order]
+
+    seqs = np.asarray(seqs).astype(bytes)
+    hit = np.zeros((len(seqs), len(anchors)), dtype=bool)
+    for j in range(0, len(seqs), batch_size):
+        codes = util.kmer_codes(seqs[j : j + batch_size], anchor_length)
+        idx = np.minimum(np.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+        rows, cols = np.nonzero(sorted_codes[idx] == codes)
+        hit[j + rows, order[idx[rows, cols]]] = True
+
+    hit_5prime, hit_3prime = hit[:, 0::2], hit[:, 1::2]
+    tie = hit_5prime.sum(1) > 1
+    hit_5prime[tie] &= hit_3prime[tie]
+    assigned = hit_5prime.sum(1) == 1
+    locus = np.full(len(seqs), "", dtype=object)
+    locus[assigned] = np.array(templates, dtype=object)[np.argmax(hit_5prime[assigned], 1)]
+    return locus
+
+
+def demultiplex_CARLIN_loci(
+    df_input, templates=["cCARLIN", "Tigre", "Rosa"], anchor_length=12, **kwargs
+):
+    """
+    Split the reads of a library that pools several CARLIN loci, and run CARLIN_preprocessing
+    on each locus, instead of scanning all reads once per template.
+
+    Parameters
+    ----------
+    df_input: pd.DataFrame
+        input data, from CARLIN_raw_reads
+    templates:
+        The loci to look for, among {'cCARLIN','Tigre','Rosa'}
+    anchor_length:
+        Length of the primer anchors, see assign_CARLIN_locus
+    kwargs:
+        Passed to CARLIN_preprocessing
+
+    Returns
+    -------
+    df_dict:
+        {template: CARLIN table of this locus, from CARLIN_preprocessing}
+    df_unassigned:
+        The input reads that match no locus, or several
+    """
+    codes, seqs = pd.factorize(df_input["clone_id"])
+    locus = assign_CARLIN_locus(np.asarray(seqs), templates, anchor_length)[codes]
+    if "read" in df_input.columns:
+        read = df_input["read"].to_numpy()
+    else:
+        read = np.ones(len(df_input), dtype=int)
+
+    df_dict = {}
+    for template in templates:
+        idx = locus == template
+        print(f"------ {template}: {read[idx].sum()} reads ({read[idx].sum()/read.sum():.3f})")
+        if idx.sum() > 0:
+            df_dict[template] = CARLIN_preprocessing(
+                df_input[idx], template=template, **kwargs
+            )
+    df_unassigned = df_input[locus == ""]
+    print(f"Unassigned reads: {read[locus==''].sum()} ({read[locus==''].sum()/read.sum():.3f})")
+    return df_dict, df_unassigned
 
 
 #########################################
@@ -1,9 +1,9 @@
-import gzip
+import hashlib
 import os
+from collections import Counter
 
 import numpy as np
 import pandas as pd
-from Bio import pairwise2
 
 pd.options.mode.chained_assignment = None  # default='warn'
 import scipy.sparse as ssp
@@ -13,6 +13,8 @@ from matplotlib import pyplot as plt
 from tqdm import tqdm
 from umi_tools import UMIClusterer
 
+import mosaiclineage.util as util
+
 #########################################################
 
 ## We put functions for extracting and
@@ -31,50 +33,139 @@ from umi_tools import UMIClusterer
 ###############################
 
 
-def generate_LARRY_read_count_table(data_path, sample_list, recompute=False):
+def _count_LARRY_lines(lines, counts):
+    """
+    Count the (header, sequence) pairs among consecutive lines of a LARRY fastq file.
+
+    A sequence line is counted if the line right before it is a header with
+    3 fields ('>sample,cell_bc,umi'). Lines are kept as bytes, and the counting is done
+    without decoding each line.
+    """
+    lines = np.array(lines)
+    first_char = lines.astype("S1")
+    valid_header = (first_char == b">") & (np.char.count(lines, b",") == 2)
+    is_seq = (first_char != b">") & (first_char != b"")
+    idx = np.nonzero(valid_header[:-1] & is_seq[1:])[0]
+    counts.update(zip(lines[idx].tolist(), lines[idx + 1].tolist()))
+
+
+def count_LARRY_fastq(file_name, block_size=2 ** 26):
+    """
+    Stream a LARRY fastq file in large binary blocks, and count the reads of each
+    (header, sequence) pair. Only the unique pairs are kept in memory.
+
+    Returns a Counter with keys (b'>sample,cell_bc,umi', b'clone_barcode')
+    """
+    counts = Counter()
+    tail = b"\n"  # an empty line as the context of the first line
+    with util.open_fastq(file_name) as handle:
+        progress = tqdm(unit="B", unit_scale=True)
+        while True:
+            block = handle.read(block_size)
+            lines = (tail + block).split(b"\n")
+            if len(block) > 0:
+                # keep the last complete line as the context of the next block, together with the unfinished line
+                tail = lines[-2] + b"\n" + lines[-1]
+                lines = lines[:-1]
+            _count_LARRY_lines(lines, counts)
+            progress.update(len(block))
+            if len(block) == 0:
+                break
+        progress.close()
+    return counts
+
+
+def _file_cache_key(file_name):
+    """
+    A key that changes whenever the source file is modified, based on its size and mtime
+    """
+    stat = os.stat(file_name)
+    return hashlib.md5(f"{stat.st_size}_{stat.st_mtime_ns}".encode()).hexdigest()
+
+
+def _save_table_cache(df, file_name, cache_key):
     """
-    From f"{data_path}/{lib}.LARRY.fastq.gz" --> f"{data_path}/{lib}.LARRY.csv"
+    Save a table as a compressed columnar .npz file, where string columns are
+    dictionary-encoded (integer codes + unique values)
+    """
+    arrays = {"cache_key": np.array(cache_key), "columns": np.array(df.columns, dtype=str)}
+    for j, key in enumerate(df.columns):
+        if pd.api.types.is_numeric_dtype(df[key]):
+            arrays[f"values_{j}"] = df[key].to_numpy()
+        else:
+            codes, categories = pd.factorize(df[key])
+            if len(categories) < 2 ** 31:
+                codes = codes.astype(np.int32)
+            arrays[f"codes_{j}"] = codes
+            arrays[f"categories_{j}"] = np.array(categories, dtype=str)
+    np.savez_compressed(file_name, **arrays)
+
+
+def _load_table_cache(file_name, cache_key=None):
+    """
+    Load a table saved by _save_table_cache. Return None if the file does not exist,
+    or if it was built from a different version of the source file (cache_key mismatch).
+    """
+    if not os.path.exists(file_name):
+        return None
+    with np.load(file_name, allow_pickle=False) as cache:
+        if (cache_key is not None) and (str(cache["cache_key"]) != cache_key):
+            return None
+        data = {}
+        for j, key in enumerate(cache["columns"].tolist()):
+            if f"values_{j}" in cache.files:
+                data[key] = cache[f"values_{j}"]
+            else:
+                data[key] = pd.Categorical.from_codes(
+                    cache[f"codes_{j}"], cache[f"categories_{j}"]
+                ).astype(object)
+    return pd.DataFrame(data)
+
+
+def generate_LARRY_read_count_table(
+    data_path, sample_list, recompute=False, export_csv=False
+):
+    """
+    From f"{data_path}/{lib}.LARRY.fastq.gz" --> f"{data_path}/{lib}.LARRY.npz"
     where the read number of each molecular is calculated.
 
     We use cell barcode + sample id to jointly update the cell_id tag
     We use the cell barcode + umi to jointly define the umi_id tag
 
-    We first load all data into memory before extract the read information. This assumes that
-    the data is not too big to fit into the memory (<10G ?)
+    The fastq file is streamed in blocks (see count_LARRY_fastq), so that the memory
+    scales with the number of unique molecules, not the file size.
+
+    The result is cached in a compressed columnar file (f"{lib}.LARRY.npz"), with
+    dictionary-encoded string columns. The cache is keyed by the size and mtime of the fastq file,
+    and is rebuilt automatically when the fastq file changes, or with recompute=True.
+
+    export_csv:
+        Also write the table to f"{data_path}/{lib}.LARRY.csv"
     """
 
     df_list = []
     for lib in sample_list:
-        csv_file_name = f"{data_path}/{lib}.LARRY.csv"
-        if os.path.exists(csv_file_name) and (not recompute):
-            data_table = pd.read_csv(csv_file_name, index_col=0)
+        fastq_file_name = f"{data_path}/{lib}.LARRY.fastq.gz"
+        cache_file_name = f"{data_path}/{lib}.LARRY.npz"
+        if os.path.exists(fastq_file_name):
+            cache_key = _file_cache_key(fastq_file_name)
         else:
-            counts = {}
-            f = gzip.open(f"{data_path}/{lib}.LARRY.fastq.gz")
+            print(f"{fastq_file_name} not found. Use the cached table without validation")
+            cache_key = None
 
-            # for other files that starts with a normal line, skip the above two lines and run directly:
+        data_table = None
+        if not recompute:
+            data_table = _load_table_cache(cache_file_name, cache_key)
+        if data_table is None:
             print(f"Reading in library {lib}")
-            all_lines = f.readlines()
-            current_tag = []
-            for x in tqdm(all_lines):
-                l = x.decode("utf-8").strip("\n")
-                if l == "":
-                    current_tag = []
-                elif l[0] == ">":
-                    current_tag = l[1:].split(",")
-                elif l != "" and len(current_tag) == 3:
-                    current_tag.append(l)
-                    current_tag = tuple(current_tag)
-                    if not current_tag in counts:
-                        counts[current_tag] = 0
-                    counts[current_tag] += 1
-
-            sample_id = [k[0] for k, v in counts.items()]
-            cell_bc = [k[1] for k, v in counts.items()]
-            umi_id = [k[2] for k, v in counts.items()]
-            gfp_bc_id = [k[3] for k, v in counts.items()]
-            read_count = [v for k, v in counts.items()]
-            library_id = [lib for _ in range(len(sample_id))]
+            counts = count_LARRY_fastq(fastq_file_name)
+
+            tag_list = [k[0][1:].decode("utf-8").split(",") for k in counts.keys()]
+            cell_bc = [x[1] for x in tag_list]
+            umi_id = [x[2] for x in tag_list]
+            gfp_bc_id = [k[1].decode("utf-8") for k in counts.keys()]
+            read_count = list(counts.values())
+            library_id = [lib for _ in range(len(tag_list))]
 
             data_table = pd.DataFrame(
                 {"library": library_id, "umi": umi_id, "cell_bc": cell_bc}
@@ -83,13 +174,32 @@ def generate_LARRY_read_count_table(data_path, sample_list, recompute=False):
             data_table["cell_id"] = data_table["library"] + "_" + data_table["cell_bc"]
             data_table["clone_id"] = gfp_bc_id
             data_table["read"] = read_count
-            data_table.to_csv(f"{data_path}/{lib}.LARRY.csv")
+            _save_table_cache(data_table, cache_file_name, cache_key)
 
+        if export_csv:
+            data_table.to_csv(f"{data_path}/{lib}.LARRY.csv")
         df_list.append(data_table)
     df_all = pd.concat(df_list)
     return df_all
 
 
+def _denoise_partition(seqs_list, reads_list, denoise_kwargs):
+    """
+    Worker for denoise_clonal_data. Denoise each sample of one partition independently,
+    and return the corrected sequences of each sample.
+    """
+    kwargs = dict(progress_bar=False)
+    kwargs.update(denoise_kwargs)
+    new_seq_lists = []
+    for seqs, reads in zip(seqs_list, reads_list):
+        if len(seqs) == 0:
+            new_seq_lists.append(seqs)
+            continue
+        mapping, new_seq_list = denoise_sequence(seqs, read_count=reads, **kwargs)
+        new_seq_lists.append(new_seq_list)
+    return new_seq_lists
+
+
 def denoise_clonal_data(
     df_raw,
     target_key="clone_id",
@@ -101,6 +211,9 @@ def denoise_clonal_data(
     plot_report=True,
     group_keys=["library", "cell_id", "cell_bc", "clone_id", "umi"],
     progress_bar=True,
+    n_jobs=1,
+    max_concurrent_partitions=None,
+    executor=None,
 ):
     """
     Denoise sequencing/PCR errors at a particular field.
@@ -115,6 +228,8 @@ def denoise_clonal_data(
         or `CARLIN.CARLIN_raw_reads` (typically further filtered by CARLIN.CARLIN_preprocessing)
     target_key:
         The target field to correct sequeuncing/PCR errors.
+        If target_key is packed (see pack_barcodes), it stays packed: the method "Hamming" compares the
+        2-bit codes directly, and the other methods decode only its unique values (see denoise_sequence).
     read_cutoff:
         Only use sequences >= this read_cutoff
     denoise_method:
@@ -122,16 +237,25 @@ def denoise_clonal_data(
     per_sample:
         denoise for each sample sepaerately, where we adjust the read threshold per sample.
         This can be cell or library.  The right input could be: None, 'cell_id', 'library'
+        With packed barcodes (no 'cell_id' column), 'cell_id' means each ['library', 'cell_bc'].
     distance_threshold:
         distances to connect two sequences.
     whiteList:
-        Only works for the method "Hamming"
+        Only works for the method "Hamming". Each sequence is assigned to its nearest whitelist entry
+        (see match_whitelist); sequences equally close to several entries are reported and left out.
     plot_report:
         Show the report of correction, like clone size etc
     group_keys:
         A list of keys to aggregate the sequences and sum over the read counts
     progress_bar:
         show progress bar
+    n_jobs:
+        With per_sample, the samples are grouped once, split into about 4*n_jobs partitions
+        of similar row number, and denoised in n_jobs worker processes. n_jobs=1 runs in this process.
+    max_concurrent_partitions:
+        Maximum number of partitions sent to the workers at the same time. Default: n_jobs
+    executor:
+        See util.map_bounded
 
     Returns:
     --------
@@ -139,48 +263,95 @@ def denoise_clonal_data(
     """
 
     df_input = df_raw.copy()
+    # barcodes from pack_barcodes are denoised as codes (see denoise_sequence)
+    packed_target = pd.api.types.is_integer_dtype(df_input[target_key])
     sp_idx_0 = df_input["read"] >= read_cutoff
     if progress_bar:
         print(
             f"Currently cleaning {target_key}; number of unique elements: {len(set(df_input[target_key][sp_idx_0]))}"
         )
-    if (per_sample is not None) and (per_sample in df_input.columns):
+    sp_idx = (df_input["read"] >= read_cutoff).to_numpy()
+    denoise_kwargs = dict(
+        distance_threshold=distance_threshold,
+        whiteList=whiteList,
+        method=denoise_method,
+    )
+    if per_sample is not None:
+        if per_sample in df_input.columns:
+            sample_keys = [per_sample]
+        elif (per_sample == "cell_id") and {"library", "cell_bc"}.issubset(df_input.columns):
+            sample_keys = ["library", "cell_bc"]  # packed barcodes, see pack_barcodes
+        else:
+            raise ValueError(f"per_sample: {per_sample} is not a column of df_raw")
         print(f"Denoising mode: per {per_sample}")
-        sample_id_list = list(set(df_input[per_sample]))
-        df_list = []
-        for j in range(len(sample_id_list)):
-            sample_id_temp = sample_id_list[j]
-            df_temp = df_input[df_input[per_sample] == sample_id_temp]
-
-            sp_idx = df_temp["read"] >= read_cutoff
-            if np.sum(sp_idx) > 0:
-                mapping, new_seq_list = denoise_sequence(
-                    df_temp[sp_idx][target_key],
-                    read_count=df_temp[sp_idx]["read"],
-                    distance_threshold=distance_threshold,
-                    whiteList=whiteList,
-                    method=denoise_method,
-                    progress_bar=False,
-                )
+        # group once: rows above the cutoff, sorted by sample (stable, so that each
+        # sample keeps its row order), and cut at the sample boundaries
+        sample_codes = (
+            df_input.groupby(sample_keys, sort=False, dropna=True)
+            .ngroup()
+            .fillna(-1)
+            .to_numpy(dtype=np.int64)
+        )
+        rows = np.nonzero(sp_idx & (sample_codes >= 0))[0]
+        rows = rows[np.argsort(sample_codes[rows], kind="stable")]
+        bounds = np.r_[
+            0, np.nonzero(np.diff(sample_codes[rows]))[0] + 1, len(rows)
+        ]
+        row_groups = [rows[bounds[j] : bounds[j + 1]] for j in range(len(bounds) - 1)]
+    else:
+        row_groups = [np.nonzero(sp_idx)[0]]
 
-                df_temp[target_key][sp_idx] = new_seq_list
-                df_temp[target_key][~sp_idx] = np.nan
-                df_temp[target_key][df_temp[target_key] == "nan"] = np.nan
-            df_list.append(df_temp)
-        df_HQ = pd.concat(df_list).dropna()
+    seqs = df_input[target_key].to_numpy()
+    reads = df_input["read"].to_numpy()
+    if len(row_groups) == 1:
+        partitions = [row_groups]
     else:
-        sp_idx = df_input.read >= read_cutoff
-        mapping, new_seq_list = denoise_sequence(
-            df_input[sp_idx][target_key],
-            read_count=df_input[sp_idx]["read"],
-            distance_threshold=distance_threshold,
-            whiteList=whiteList,
-            method=denoise_method,
+        # consecutive samples with a similar total row number per partition
+        n_partitions = 4 * n_jobs
+        group_sizes = np.array([len(x) for x in row_groups])
+        row_start = np.cumsum(group_sizes) - group_sizes
+        partition_codes = (row_start * n_partitions) // group_sizes.sum()
+        partitions = [
+            [row_groups[j] for j in np.nonzero(partition_codes == code)[0]]
+            for code in np.unique(partition_codes)
+        ]
+    args_list = [
+        ([seqs[x] for x in groups], [reads[x] for x in groups], denoise_kwargs)
+        for groups in partitions
+    ]
+
+    if (len(args_list) > 1) and ((n_jobs > 1) or (executor is not None)):
+        results = util.map_bounded(
+            _denoise_partition,
+            args_list,
+            n_jobs=n_jobs,
+            executor=executor,
+            max_concurrent=max_concurrent_partitions,
             progress_bar=progress_bar,
         )
-        df_input[target_key][sp_idx] = new_seq_list
-        df_input[target_key][~sp_idx] = np.nan
-        df_input[target_key][df_input[target_key] == "nan"] = np.nan
+    else:
+        denoise_kwargs["progress_bar"] = progress_bar and (len(args_list) == 1)
+        results = [
+            _denoise_partition(*args)
+            for args in tqdm(
+                args_list, disable=(not progress_bar) or (len(args_list) == 1)
+            )
+        ]
+
+    # write back through the row indices; rows below the cutoff are dropped
+    if packed_target:
+        new_target = np.zeros(len(df_input), dtype=seqs.dtype)  # 0: not a valid code
+    else:
+        new_target = np.full(len(df_input), np.nan, dtype=object)
+    for groups, new_seq_groups in zip(partitions, results):
+        for group, new_seq_list in zip(groups, new_seq_groups):
+            new_target[group] = new_seq_list
+    if packed_target:
+        df_input[target_key] = new_target
+        df_HQ = df_input[new_target > 0].dropna()
+    else:
+        new_target[new_target == "nan"] = np.nan
+        df_input[target_key] = new_target
         df_HQ = df_input.dropna()
 
     # update group keys
@@ -202,6 +373,8 @@ def denoise_clonal_data(
 
         if denoise_method != "alignment":
             fig, axs = plt.subplots(1, 2, figsize=(10, 4))
+            if packed_target:
+                unique_seq = list(util.decode_2bit(unique_seq))
             distance = QC_sequence_distance(unique_seq)
             min_dis = plot_seq_distance(distance, ax=axs[0])
             QC_read_coverage(df_HQ, target_key=target_key, ax=axs[1])
@@ -211,6 +384,201 @@ def denoise_clonal_data(
     return df_HQ_1
 
 
+def _build_block_index(X, distance_threshold):
+    """
+    Pigeonhole index for Hamming neighbors: two sequences within distance d share at least one
+    of d+1 blocks exactly. X is a (n, L) uint8 matrix. The blocks interleave the columns
+    (block b takes the columns b, b+d+1, ...), so that a shared prefix, e.g., a library name,
+    does not put all rows in one bucket. For each block, the rows are grouped by the block content,
+    so that the rows sharing a block with row i are one slice.
+
+    Returns a list of (columns, block uniques, block code of each row, rows sorted by code, slice starts)
+    """
+    if distance_threshold >= X.shape[1]:
+        # every pair is within the threshold: one block shared by all rows
+        n = X.shape[0]
+        codes = np.zeros(n, dtype=np.int64)
+        return [(np.arange(0), pd.Index([b""]), codes, np.arange(n), np.array([0, n]))]
+    index = []
+    for b in range(distance_threshold + 1):
+        cols = np.arange(b, X.shape[1], distance_threshold + 1)
+        block = np.ascontiguousarray(X[:, cols]).view(f"S{len(cols)}").ravel()
+        codes, uniques = pd.factorize(block)
+        order = np.argsort(codes, kind="stable")
+        starts = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        index.append((cols, pd.Index(uniques), codes, order, starts))
+    return index
+
+
+def _block_candidates(index, block_codes):
+    """
+    Rows of the block index that share at least one block with a sequence, given the
+    code of each of its blocks (-1 if the block content is not in the index)
+    """
+    candidates = [
+        order[starts[code] : starts[code + 1]]
+        for (cols, uniques, codes, order, starts), code in zip(index, block_codes)
+        if code >= 0
+    ]
+    if len(candidates) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(candidates))
+
+
+def _block_query_codes(index, Y):
+    """
+    Code of each block of the rows of a (m, L) uint8 matrix Y in a block index
+    (-1 if the block content is not in the index). Returns a (block number, m) array.
+    """
+    query_codes = []
+    for cols, uniques, codes, order, starts in index:
+        if len(cols) == 0:
+            query_codes.append(np.zeros(len(Y), dtype=np.int64))
+        else:
+            block = np.ascontiguousarray(Y[:, cols]).view(f"S{len(cols)}").ravel()
+            query_codes.append(uniques.get_indexer(block))
+    return np.array(query_codes, dtype=np.int64).reshape(len(index), len(Y))
+
+
+def _block_pair_count(index, query_codes):
+    """
+    Number of candidate rows of each query (counted once per shared block), from _block_query_codes
+    """
+    pair_N = np.zeros(query_codes.shape[1], dtype=np.int64)
+    for (cols, uniques, codes, order, starts), code in zip(index, query_codes):
+        valid = code >= 0
+        pair_N[valid] += starts[code[valid] + 1] - starts[code[valid]]
+    return pair_N
+
+
+def _block_pairs(index, query_codes):
+    """
+    All (query, row) pairs between the queries (given by their codes from _block_query_codes)
+    and the rows of a block index that share at least one block, expanded with vectorized operations.
+    """
+    query_list, row_list = [], []
+    for b, ((cols, uniques, codes, order, starts), code) in enumerate(zip(index, query_codes)):
+        query = np.nonzero(code >= 0)[0]
+        start = starts[code[query]]
+        size = starts[code[query] + 1] - start
+        offset = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+        query = np.repeat(query, size)
+        row = order[np.repeat(start, size) + offset]
+        # a pair sharing several blocks is only kept at the first one (no sort to deduplicate)
+        keep = np.ones(len(query), dtype=bool)
+        for block_earlier, code_earlier in zip(index[:b], query_codes[:b]):
+            keep &= block_earlier[2][row] != code_earlier[query]
+        query_list.append(query[keep])
+        row_list.append(row[keep])
+    return np.concatenate(query_list), np.concatenate(row_list)
+
+
+def _chunk_bounds(pair_N, batch_size, max_pairs):
+    """
+    Cut consecutive queries into chunks of at most batch_size queries and at most max_pairs
+    candidate pairs (a query with more candidates than max_pairs gets a chunk of its own)
+    """
+    cum_pair_N = np.cumsum(pair_N)
+    bounds = [0]
+    while bounds[-1] < len(pair_N):
+        start = bounds[-1]
+        offset = cum_pair_N[start - 1] if start > 0 else 0
+        stop = np.searchsorted(cum_pair_N, offset + max_pairs, side="right")
+        bounds.append(min(max(stop, start + 1), start + batch_size))
+    return bounds
+
+
+def match_whitelist(
+    seqs, whiteList, distance_threshold=1, batch_size=100000, max_pairs=4000000
+):
+    """
+    Map each sequence to its nearest whitelist entry within distance_threshold (Hamming distance;
+    only entries of the same length are compared).
+
+    The whitelist is indexed once by pigeonhole blocks (see _build_block_index), and the candidate
+    entries of a batch of sequences are expanded and compared at once, so that the cost
+    scales with the number of candidates instead of (sequences x whitelist).
+    Each batch has at most batch_size sequences and max_pairs candidate pairs, which bounds
+    the memory: with a large whitelist and distance_threshold>=2, a sequence can have
+    thousands of candidates.
+
+    Returns a dataframe with one row per unique sequence: 'seq', 'whitelist_seq', 'distance'
+    and 'match_N', the number of whitelist entries at this distance. If match_N>1, the match is
+    ambiguous, and 'whitelist_seq' is left empty (None), as when no entry is within the threshold.
+    """
+    seqs = pd.unique(np.asarray(seqs).astype(bytes)).astype(bytes)
+    whiteList = pd.unique(np.asarray(whiteList).astype(bytes)).astype(bytes)
+    seq_length = np.char.str_len(seqs)
+    whiteList_length = np.char.str_len(whiteList)
+
+    best_seq = np.full(len(seqs), None, dtype=object)
+    best_distance = np.full(len(seqs), -1, dtype=np.int64)
+    match_N = np.zeros(len(seqs), dtype=np.int64)
+    for L in np.intersect1d(seq_length, whiteList_length):
+        W_idx = np.nonzero(whiteList_length == L)[0]
+        W = whiteList[W_idx].astype(f"S{max(L, 1)}")
+        X_W = W.view(np.uint8).reshape(len(W), -1)
+        index = _build_block_index(X_W, distance_threshold)
+        S_idx = np.nonzero(seq_length == L)[0]
+        X_S = seqs[S_idx].astype(f"S{max(L, 1)}").view(np.uint8).reshape(len(S_idx), -1)
+        planes_W, planes_S = util.pack_bitplanes(X_W, X_S)
+        query_codes = _block_query_codes(index, X_S)
+        bounds = _chunk_bounds(_block_pair_count(index, query_codes), batch_size, max_pairs)
+        for j, j_end in zip(bounds[:-1], bounds[1:]):
+            idx = S_idx[j:j_end]
+            query, row = _block_pairs(index, query_codes[:, j:j_end])
+            distance = util.hamming_distance_bitplanes(planes_S[j:j_end][query], planes_W[row])
+            keep = distance <= distance_threshold
+            query, row, distance = query[keep], row[keep], distance[keep]
+            if len(query) == 0:
+                continue
+            # nearest entries of each query: sort by (query, distance)
+            order = np.lexsort((distance, query))
+            query, row, distance = query[order], row[order], distance[order]
+            first = np.r_[True, query[1:] != query[:-1]]
+            min_distance = np.repeat(distance[first], np.diff(np.r_[np.nonzero(first)[0], len(query)]))
+            n_min = np.bincount(query[distance == min_distance], minlength=len(idx))
+            best_distance[idx[query[first]]] = distance[first]
+            match_N[idx] = n_min
+            unique_match = first & (n_min[query] == 1)
+            best_seq[idx[query[unique_match]]] = W[row[unique_match]]
+
+    return pd.DataFrame(
+        {
+            "seq": seqs,
+            "whitelist_seq": best_seq,
+            "distance": best_distance,
+            "match_N": match_N,
+        }
+    )
+
+
+def _LCS_distance(peq, m, y, max_distance):
+    """
+    max(m, len(y)) - LCS(x, y), for x of length m given by its match masks peq ({base: bit mask}).
+    This equals max_length - score of pairwise2.align.globalxx.
+
+    The LCS is computed with the bit-parallel algorithm of Allison-Dix/Hyyro, with python integers
+    as bit vectors (any length). The computation stops early, returning max_distance+1, once the
+    LCS cannot reach max(m, len(y)) - max_distance anymore.
+
+    The bit vectors are not restricted to a diagonal band: a 300 bp CARLIN sequence is only
+    five 64-bit words, so the cost is the python loop over the bases of y, which a band does not
+    shorten, and masking a band would add work to every step.
+    """
+    full = (1 << m) - 1
+    V = full
+    n = len(y)
+    min_LCS = max(m, n) - max_distance
+    for i, c in enumerate(y):
+        U = V & peq.get(c, 0)
+        V = ((V + U) | (V - U)) & full
+        # the LCS grows by at most one per remaining base
+        if ((i & 15) == 15) and (m - bin(V).count("1") + n - i - 1 < min_LCS):
+            return max_distance + 1
+    return max(m, n) - (m - bin(V).count("1"))
+
+
 def denoise_sequence(
     input_seqs,
     read_count=None,
@@ -225,14 +593,19 @@ def denoise_sequence(
 
     Note that the output seq list could contain 'nan' if whitelist is used
 
-    sequence distance <= 'distance_threshold' are connected
+    sequence distance <= 'distance_threshold' are connected. With method="Hamming", only sequences
+    of the same length are compared, so sequences of different lengths are never connected.
 
     Parameters:
     -----------
     method:
         "Hamming",  "UMI_tools", "alignment"
     seq_list:
-        can be a list with duplicate sequences, indicating the read abundance of the read
+        can be a list with duplicate sequences, indicating the read abundance of the read.
+        It can also be integer codes from util.encode_2bit (see pack_barcodes). The method "Hamming"
+        without whitelist then compares the codes directly (see util.bitplanes_2bit); the other methods
+        decode the unique codes, and encode the result back. The output is then codes as well,
+        with 0 (not a valid code) in place of 'nan'.
     """
 
     if method not in ["Hamming", "UMI_tools", "alignment"]:
@@ -240,7 +613,29 @@ def denoise_sequence(
             'method should be among  {"Hamming",  "UMI_tools", "alignment"}'
         )
 
-    seq_list = np.array(input_seqs).astype(bytes)
+    seq_list = np.asarray(input_seqs)
+    packed = seq_list.dtype.kind in "ui"
+    if packed and ((method != "Hamming") or (whiteList is not None)):
+        # only the Hamming method without whitelist works on the codes
+        unique_codes, inverse = np.unique(seq_list, return_inverse=True)
+        mapping, new_seq_list = denoise_sequence(
+            util.decode_2bit(unique_codes)[inverse],
+            read_count=read_count,
+            distance_threshold=distance_threshold,
+            method=method,
+            whiteList=whiteList,
+            progress_bar=progress_bar,
+        )
+        mapping = {
+            util.encode_2bit([x])[0]: util.encode_2bit([y])[0] for x, y in mapping.items()
+        }
+        new_codes = np.zeros(len(seq_list), dtype=seq_list.dtype)
+        valid = new_seq_list != "nan"
+        if valid.sum() > 0:
+            new_codes[valid] = util.encode_2bit(new_seq_list[valid])
+        return mapping, new_codes
+    if not packed:
+        seq_list = seq_list.astype(bytes)
 
     if read_count is None:
         read_count = np.ones(len(seq_list))
@@ -248,7 +643,7 @@ def denoise_sequence(
         raise ValueError("read_count does not have the same size as input_seqs")
     df = pd.DataFrame({"seq": seq_list, "read": read_count})
     df = (
-        df.groupby("seq").sum("read").reset_index().sort_values("read", ascending=False)
+        df.groupby("seq").sum(numeric_only=True).reset_index().sort_values("read", ascending=False)
     )
     if method == "UMI_tools":
         if whiteList is not None:
@@ -280,50 +675,55 @@ def denoise_sequence(
         if progress_bar:
             print(f"Processing {len(unique_seq_list)} unique sequences")
         remaining_seq_idx = np.ones(len(unique_seq_list)).astype(bool)
-        source_seqs = np.array([list(xx) for xx in unique_seq_list])
         if whiteList is None:
-            iter = range(len(unique_seq_list))
-            if progress_bar:
-                iter = tqdm(iter)
-            for __ in iter:
-                cur_ids = np.nonzero(remaining_seq_idx)[0]
-                id_0 = cur_ids[0]
-                cur_seq = unique_seq_list[id_0]
-                remain_seq_array = source_seqs[remaining_seq_idx]
-                distance_vector = np.sum(remain_seq_array != remain_seq_array[0], 1)
-                target_ids = np.nonzero(distance_vector <= distance_threshold)[0]
-                for k in target_ids:
-                    abs_id = cur_ids[k]
-                    seq_tmp = unique_seq_list[abs_id]
-                    mapping[seq_tmp] = cur_seq
-                    remaining_seq_idx[
-                        abs_id
-                    ] = False  # switch to idx to prevent modifying id list dynamically
-
-                if np.sum(remaining_seq_idx) <= 0:
-                    break
-        else:
-            whiteList_1 = np.array(whiteList).astype(bytes)
-            target_seqs = np.array([list(xx) for xx in whiteList_1])
-            iter = range(len(whiteList_1))
-            if progress_bar:
-                iter = tqdm(iter)
-            for j in iter:
-                cur_seq = whiteList_1[j]
-                if distance_threshold > 0:
-                    cur_ids = np.nonzero(remaining_seq_idx)[0]
-                    remain_seq_array = source_seqs[remaining_seq_idx]
-                    distance_vector = np.sum(remain_seq_array != target_seqs[j], 1)
-                    target_ids = np.nonzero(distance_vector <= distance_threshold)[0]
-                    for k in target_ids:
-                        abs_id = cur_ids[k]
-                        seq_tmp = unique_seq_list[abs_id]
-                        mapping[seq_tmp] = cur_seq
-                        remaining_seq_idx[
-                            abs_id
-                        ] = False  # switch to idx to prevent modifying id list dynamically
+            # From the most abundant sequence down, merge the remaining sequences within the threshold.
+            # The Hamming distance is only defined between sequences of the same length, so each length
+            # bucket is processed on its own, as a padded uint8 matrix. The candidates come from a pigeonhole
+            # block index, instead of a scan over all remaining sequences.
+            seq_array = np.array(unique_seq_list)
+            if packed:
+                seq_length = util.length_2bit(seq_array)
+            else:
+                seq_length = np.char.str_len(seq_array)
+            progress = tqdm(total=len(unique_seq_list), disable=not progress_bar)
+            for L in np.unique(seq_length):
+                bucket_ids = np.nonzero(seq_length == L)[0]
+                if packed:
+                    # work on the 2-bit codes, without decoding them to strings
+                    X = util.symbols_2bit(seq_array[bucket_ids], L)
+                    planes = util.bitplanes_2bit(seq_array[bucket_ids], L)
                 else:
-                    mapping[cur_seq] = cur_seq
+                    X = seq_array[bucket_ids].astype(f"S{max(L, 1)}").view(np.uint8)
+                    X = X.reshape(len(bucket_ids), -1)
+                    planes = util.pack_bitplanes(X)[0]
+                index = _build_block_index(X, distance_threshold)
+                for k_0, id_0 in enumerate(bucket_ids):
+                    progress.update(1)
+                    if not remaining_seq_idx[id_0]:
+                        continue
+                    cur_seq = unique_seq_list[id_0]
+                    cur_ks = _block_candidates(index, [x[2][k_0] for x in index])
+                    cur_ks = cur_ks[remaining_seq_idx[bucket_ids[cur_ks]]]
+                    distance_vector = util.hamming_distance_bitplanes(
+                        planes[cur_ks], planes[k_0]
+                    )
+                    for abs_id in bucket_ids[cur_ks[distance_vector <= distance_threshold]]:
+                        mapping[unique_seq_list[abs_id]] = cur_seq
+                        remaining_seq_idx[abs_id] = False
+            progress.close()
+        else:
+            # each sequence goes to its unique nearest whitelist entry, through a whitelist index
+            df_match = match_whitelist(unique_seq_list, whiteList, distance_threshold)
+            ambiguous = (df_match["match_N"] > 1).to_numpy()
+            if ambiguous.sum() > 0:
+                ambiguous_read = df["read"].to_numpy()[ambiguous].sum()
+                print(
+                    f"{ambiguous.sum()} sequences ({ambiguous_read} reads) are equally close to several whitelist entries; they are not assigned"
+                )
+            matched = df_match["whitelist_seq"].notna().to_numpy()
+            mapping = dict(
+                zip(df_match["seq"][matched], df_match["whitelist_seq"][matched])
+            )
 
     elif method == "alignment":
         # do not accept Whitelist here
@@ -332,58 +732,65 @@ def denoise_sequence(
         unique_seq_list = list(df["seq"])
         read_list = list(df["read"])
 
+        read_array = np.array(read_list)
         if progress_bar:
             print(f"Processing {len(unique_seq_list)} unique sequences")
         remaining_seq_idx = np.ones(len(unique_seq_list)).astype(bool)
-        source_seqs = np.array(unique_seq_list).astype(str)
+        seq_length = np.array([len(x) for x in unique_seq_list])
+        # base composition: the LCS is at most the shared count of each base
+        # (A, C, G, T, and all other characters together, which keeps it an upper bound)
+        base_code = np.full(256, 4, dtype=np.int64)
+        base_code[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4)
+        all_bases = np.frombuffer(b"".join(unique_seq_list), dtype=np.uint8)
+        base_count = np.bincount(
+            np.repeat(np.arange(len(unique_seq_list)), seq_length) * 5 + base_code[all_bases],
+            minlength=5 * len(unique_seq_list),
+        ).reshape(-1, 5).astype(np.int32)
+        # bucket the sequences by length
+        length_order = np.argsort(seq_length, kind="stable")
+        sorted_length = seq_length[length_order]
 
         iter = range(len(unique_seq_list))
         if progress_bar:
             iter = tqdm(iter)
-        for __ in iter:
-            cur_ids = np.nonzero(remaining_seq_idx)[0]
-            id_0 = cur_ids[0]
-            cur_seq = unique_seq_list[id_0]
-            remain_seq_array = source_seqs[remaining_seq_idx]
-            remain_read_counts = np.array(read_list)[remaining_seq_idx]
-
-            distance_vector = np.zeros(len(remain_seq_array))
-            X0 = remain_seq_array[0]
-            for j, Y0 in enumerate(remain_seq_array[1:]):
-                len_diff = abs(len(X0) - len(Y0))
-                if len_diff > distance_threshold:
-                    distance_vector[j + 1] = len_diff
-                else:  # compute only when necessary
-                    alignments = pairwise2.align.globalxx(X0, Y0)
-                    score = np.mean([x.score for x in alignments])
-                    max_length = np.max([len(X0), len(Y0)])
-                    distance_vector[j + 1] = max_length - score
-
-            condition_1 = (
-                remain_read_counts <= 0.1 * remain_read_counts[0]
-            )  # check that the target reads is below a threshold of the source reads
-            condition_2 = (
-                distance_vector <= distance_threshold
-            )  # check that the target reads is close to the source reads
-            target_ids_tmp = np.nonzero(condition_1 & condition_2)[0]
-            target_ids = [0] + list(
-                target_ids_tmp
-            )  # add the initial id, to ensure that the iteration is moving
-            for k in target_ids:
-                abs_id = cur_ids[k]
-                seq_tmp = unique_seq_list[abs_id]
-                mapping[seq_tmp] = cur_seq
-                remaining_seq_idx[
-                    abs_id
-                ] = False  # switch to idx to prevent modifying id list dynamically
-
-            if np.sum(remaining_seq_idx) <= 0:
-                break
-
-    if whiteList is None:
+        for id_0 in iter:
+            if not remaining_seq_idx[id_0]:
+                continue
+            X0 = unique_seq_list[id_0]
+            m = len(X0)
+
+            # cheap filters first: read ratio, length difference, and base composition
+            lo, hi = np.searchsorted(
+                sorted_length, [m - distance_threshold, m + distance_threshold + 1]
+            )
+            cur_ids = length_order[lo:hi]
+            cur_ids = cur_ids[
+                remaining_seq_idx[cur_ids]
+                & (read_array[cur_ids] <= 0.1 * read_array[id_0])
+            ]
+            shared_bases = np.minimum(base_count[cur_ids], base_count[id_0]).sum(1)
+            lower_bound = np.maximum(seq_length[cur_ids], m) - shared_bases
+            cur_ids = cur_ids[lower_bound <= distance_threshold]
+
+            peq = {}
+            for k, c in enumerate(X0):
+                peq[c] = peq.get(c, 0) | (1 << k)
+            target_ids = [id_0] + [
+                k
+                for k in cur_ids
+                if _LCS_distance(peq, m, unique_seq_list[k], distance_threshold)
+                <= distance_threshold
+            ]
+            for abs_id in target_ids:
+                mapping[unique_seq_list[abs_id]] = X0
+                remaining_seq_idx[abs_id] = False
+
+    if packed:
+        new_seq_list = np.array([mapping[xx] for xx in seq_list]).astype(seq_list.dtype)
+    elif whiteList is None:
         new_seq_list = np.array([mapping[xx] for xx in seq_list]).astype(str)
     else:
-        shared_idx = np.in1d(seq_list, list(mapping.keys()))
+        shared_idx = np.isin(seq_list, list(mapping.keys()))
         new_seq_list = np.array(seq_list).copy()
         new_seq_list[shared_idx] = [mapping[xx] for xx in seq_list[shared_idx]]
         new_seq_list = np.array(new_seq_list).astype(str)
@@ -415,7 +822,9 @@ def QC_sequence_distance(source_seqs_0, target_seqs_0=None, Kmer=1, deduplicate=
     eg. 'ABCDEF', Kmers=2 -> ['AB','CD','EF']
     Then, calculate the Hamming distance in the kmer space
 
-    This calculation is exact, and can be slow for large amount of sequences
+    This calculation is exact, and can be slow for large amount of sequences.
+    The Kmers are recoded as integers and packed into bit-planes, so that each row of the
+    distance matrix is computed with XOR and popcount (see util.pack_bitplanes).
     """
 
     if deduplicate:
@@ -433,12 +842,22 @@ def QC_sequence_distance(source_seqs_0, target_seqs_0=None, Kmer=1, deduplicate=
     ini_N = len(source_seqs)
     distance = np.zeros((ini_N, seq_N))
 
+    # recode the Kmers as integers shared by source and target
+    kmer_codes = pd.factorize(np.concatenate([source_seqs.ravel(), target_seqs.ravel()]))[0]
+    source_planes, target_planes = util.pack_bitplanes(
+        kmer_codes[: source_seqs.size].reshape(source_seqs.shape),
+        kmer_codes[source_seqs.size :].reshape(target_seqs.shape),
+    )
     if len(source_seqs) > len(target_seqs):
         for j in tqdm(range(len(target_seqs))):
-            distance[:, j] = np.sum(source_seqs != target_seqs[j], 1)
+            distance[:, j] = util.hamming_distance_bitplanes(
+                source_planes, target_planes[j]
+            )
     else:
         for j in tqdm(range(len(source_seqs))):
-            distance[j, :] = np.sum(target_seqs != source_seqs[j], 1)
+            distance[j, :] = util.hamming_distance_bitplanes(
+                target_planes, source_planes[j]
+            )
 
     return distance
 
@@ -619,45 +1038,49 @@ def obtain_read_dominant_sequences(
     This algorithm also consider sequence length. Each length will be treated differently
 
     consider_seq_length=True. This is useful for CARLIN seq analysis
+
+    Returns the input rows of the dominant sequences (all of them on ties), with 'read' replaced by the
+    read count of the sequence in the cell, and 'max_read_ratio' the fraction of reads of the cell
+    that it takes. The (cell, clone) pairs are sorted once by (cell, read), so that the max and the sum
+    of each cell come from vectorized segmented reductions.
     """
 
+    # one code per (cell, clone) pair; rows with a missing key are dropped, as in a groupby
+    cell_codes, cell_uniques = pd.factorize(df_input[cell_bc_key])
+    clone_codes, clone_uniques = pd.factorize(df_input[clone_key])
+    valid = (cell_codes >= 0) & (clone_codes >= 0)
+    pair_first, pair_codes = np.unique(
+        cell_codes[valid].astype(np.int64) * len(clone_uniques) + clone_codes[valid],
+        return_index=True,
+        return_inverse=True,
+    )[1:]
+    read = df_input["read"].to_numpy()[valid]
+    pair_read = np.bincount(pair_codes, weights=read)
+    pair_cell = cell_codes[valid][pair_first]
+
+    # sort the pairs once by (cell, read): the last pair of each cell has the max read
+    order = np.lexsort((pair_read, pair_cell))
+    sorted_cell = pair_cell[order]
+    cell_start = np.nonzero(np.r_[True, sorted_cell[1:] != sorted_cell[:-1]])[0]
+    cell_end = np.r_[cell_start[1:], len(order)] - 1
+    cell_max = np.zeros(len(cell_uniques))
+    cell_sum = np.zeros(len(cell_uniques))
+    if len(order) > 0:
+        cell_max[sorted_cell[cell_end]] = pair_read[order][cell_end]
+        cell_sum[sorted_cell[cell_start]] = np.add.reduceat(pair_read[order], cell_start)
+    # all pairs that reach the max read are kept, including ties
+    dominant = pair_read[pair_codes] == cell_max[cell_codes[valid]]
+
+    df_out = df_input[valid][dominant].drop("read", axis=1)
     if consider_seq_length:
-        group_list=[cell_bc_key, clone_key, "seq_length"]
-        df_input["seq_length"] = df_input[clone_key].apply(lambda x: len(x))
         print('seq length')
-    else:
-        group_list=[cell_bc_key, clone_key]
-
-    df_CARLIN_lenth = (
-            df_input.groupby(group_list)
-            .agg(read=("read", "sum"))
-            .reset_index()
-        )
-    
-    # Identify the max read, and its fraction
-    df_dominant_fraction = (
-        df_CARLIN_lenth.groupby([cell_bc_key])
-        .agg(
-            read=("read", "max"),
-            max_read_ratio=("read", lambda x: np.max(x) / np.sum(x)),
-        )
-        .reset_index()
-    )
-
-    # Intersect with the full data to identify sequences with the max read 
-    # (multiple clone_id could be found within the same cell_id, if they both have the max read. 
-    # Say, clone_id_1 has 10 reads, and clone_id_2 also has 10 reads. 10 is the max. So, both clone_ID are retained
-    df_out = df_CARLIN_lenth.merge(
-        df_dominant_fraction, on=[cell_bc_key, "read"], how="inner"
-    )
-
-    if consider_seq_length:
-        drop_list=['read','seq_length']
-    else:
-        drop_list=['read']
-    return df_input.drop(drop_list, axis=1).merge(
-        df_out, on=[cell_bc_key, clone_key]
-    )
+        df_out = df_out.drop("seq_length", axis=1, errors="ignore")
+        df_out["seq_length"] = df_out[clone_key].str.len()
+    df_out["read"] = pair_read[pair_codes][dominant].astype(df_input["read"].dtype)
+    df_out["max_read_ratio"] = (cell_max / np.maximum(cell_sum, 1))[
+        cell_codes[valid][dominant]
+    ]
+    return df_out.reset_index(drop=True)
 
 def QC_read_per_molecule(
     df_input_0,
@@ -798,6 +1221,44 @@ def group_cells(df_HQ, group_keys=["library", "cell_id", "clone_id"], count_UMI=
     return df_out
 
 
+def pack_barcodes(df, keys=["cell_bc", "umi"]):
+    """
+    Replace string barcode columns with 2-bit packed integers (see util.encode_2bit),
+    which use much less memory and make groupby/merge faster. denoise_clonal_data runs
+    Hamming denoising on the packed codes directly (see util.bitplanes_2bit).
+
+    The derived string columns 'cell_id' and 'umi_id' are dropped, as the packed barcodes
+    (together with 'library') already identify the cell and the umi. Decode with unpack_barcodes,
+    typically only at export.
+    """
+    df_out = df.drop([x for x in ["cell_id", "umi_id"] if x in df.columns], axis=1)
+    for key in keys:
+        if (key in df_out.columns) and (not pd.api.types.is_integer_dtype(df_out[key])):
+            df_out[key] = util.encode_2bit(df_out[key].to_numpy().astype(bytes))
+    return df_out
+
+
+def unpack_barcodes(df, keys=["cell_bc", "umi"]):
+    """
+    Decode the barcode columns packed by pack_barcodes back to strings (only the unique values
+    are decoded), and restore 'cell_id' and 'umi_id' once both of their parts are strings
+    """
+    df_out = df.copy()
+    for key in keys:
+        if (key in df_out.columns) and pd.api.types.is_integer_dtype(df_out[key]):
+            codes, uniques = pd.factorize(df_out[key])
+            df_out[key] = util.decode_2bit(np.asarray(uniques))[codes]
+
+    def is_string(key):
+        return (key in df_out.columns) and (not pd.api.types.is_integer_dtype(df_out[key]))
+
+    if is_string("library") and is_string("cell_bc"):
+        df_out["cell_id"] = df_out["library"] + "_" + df_out["cell_bc"]
+    if is_string("cell_bc") and is_string("umi"):
+        df_out["umi_id"] = df_out["cell_bc"] + "_" + df_out["umi"]
+    return df_out
+
+
 def seq_partition(n, seq):
     """
     Partition sequence into every n-bp
@@ -1,5 +1,20 @@
+import gzip
+import io
+import itertools
+import mmap
+import os
+import zlib
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
 import numpy as np
 import pandas as pd
+from tqdm import tqdm
 
 rng = np.random.default_rng()
 
@@ -76,6 +91,348 @@ def reverse_compliment(seq):
     return complement
 
 
+_complement_table = np.full(256, ord("N"), dtype=np.uint8)
+_complement_table[0] = 0  # keep the padding
+_complement_table[np.frombuffer(b"ACGTNacgtn", dtype=np.uint8)] = np.frombuffer(
+    b"TGCANtgcan", dtype=np.uint8
+)
+
+
+def reverse_compliment_array(seqs):
+    """
+    Reverse complement a whole array of sequences at once, with a translation table
+    and slice reversal. The sequences can have different lengths.
+
+    seqs:
+        A fixed-width byte array (dtype 'S', padded with b'\\x00'), or a list of str/bytes
+    Returns a fixed-width byte array. Characters other than ACGTN (or lower case) become 'N'.
+    """
+    seqs = np.asarray(seqs)
+    if seqs.dtype.kind != "S":
+        seqs = seqs.astype(bytes)
+    if len(seqs) == 0:
+        return seqs
+    X = seqs.view(np.uint8).reshape(len(seqs), -1)
+    width = X.shape[1]
+    length = (X != 0).sum(1)
+    X_rev = _complement_table[X[:, ::-1]]
+    out = np.zeros_like(X)
+    # rows of the same length need the same shift after reversal
+    for L in np.unique(length):
+        rows = np.nonzero(length == L)[0]
+        out[rows, :L] = X_rev[rows, width - L :]
+    return out.view(seqs.dtype).ravel()
+
+
+def slice_byte_array(seqs, start, stop):
+    """
+    Take seq[start:stop] for every element of a fixed-width byte array (dtype 'S'),
+    without a python loop. Elements shorter than stop are padded with b'\\x00',
+    which numpy drops when the element is read out.
+
+    start and stop can also be integer arrays, with one (non-negative) value per element.
+    """
+    seqs = np.asarray(seqs)
+    X = seqs.view(np.uint8).reshape(len(seqs), -1)
+    if (np.ndim(start) > 0) or (np.ndim(stop) > 0):
+        start = np.broadcast_to(np.asarray(start, dtype=np.int64), len(seqs))
+        stop = np.broadcast_to(np.asarray(stop, dtype=np.int64), len(seqs))
+        width = max(1, int((stop - start).max())) if len(seqs) > 0 else 1
+        idx = start[:, np.newaxis] + np.arange(width)
+        # positions outside [start, stop) read from an appended column of padding
+        X = np.pad(X, ((0, 0), (0, 1)))
+        idx = np.where((idx < stop[:, np.newaxis]) & (idx < X.shape[1] - 1), idx, -1)
+        out = np.take_along_axis(X, idx, axis=1)
+        return np.ascontiguousarray(out).view(f"S{width}").ravel()
+    if X.shape[1] < stop:
+        X = np.pad(X, ((0, 0), (0, stop - X.shape[1])))
+    return np.ascontiguousarray(X[:, start:stop]).view(f"S{stop-start}").ravel()
+
+
+_base_to_2bit = np.full(256, 4, dtype=np.uint8)  # 4: N, or any other character
+_base_to_2bit[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+
+def pack_bitplanes(*matrices):
+    """
+    Pack (n, L) matrices of symbols (e.g., the uint8 view of fixed-width byte arrays, or integer
+    codes of k-mers) into bit-planes, for Hamming distances with XOR and popcount
+    (see hamming_distance_bitplanes). All matrices must have the same L.
+
+    The symbols found across the matrices are recoded densely, and bit b of the code at position j
+    goes to bit j of plane b. DNA (ACGTN) then takes 3 bits per position instead of 8, and any other
+    alphabet stays exact.
+
+    Returns one (n, plane_N, word_N) uint64 array per matrix.
+    """
+    matrices = [np.asarray(X) for X in matrices]
+    L = matrices[0].shape[1]
+    symbols = np.unique(np.concatenate([np.unique(X) for X in matrices]))
+    plane_N = max(1, int(np.ceil(np.log2(max(len(symbols), 1)))))
+    word_N = max(1, -(-L // 64))
+    packed_list = []
+    for X in matrices:
+        codes = np.searchsorted(symbols, X)
+        planes = np.zeros((len(X), plane_N, 64 * word_N), dtype=bool)
+        for b in range(plane_N):
+            planes[:, b, :L] = (codes >> b) & 1
+        packed = np.packbits(planes, axis=-1, bitorder="little")
+        packed_list.append(np.ascontiguousarray(packed).view(np.uint64))
+    return packed_list
+
+
+def hamming_distance_bitplanes(planes_1, planes_2):
+    """
+    Hamming distance between bit-planes from pack_bitplanes (with numpy broadcasting, e.g.,
+    planes[ids] against planes[i]): XOR the planes, OR them into one mismatch bit per position,
+    and popcount whole 64-bit words.
+    """
+    mismatch = np.bitwise_or.reduce(planes_1 ^ planes_2, axis=-2)
+    return popcount(mismatch).sum(-1)
+
+
+def kmer_codes(seqs, k):
+    """
+    2-bit codes of all k-mers (k<=31) of a batch of sequences, computed for all
+    sequences and positions at once.
+
+    Returns an (n, width-k+1) uint64 matrix, where entry (i, j) encodes seqs[i][j:j+k]
+    (A=0, C=1, G=2, T=3, first base highest). k-mers that contain N, any other
+    character, or run past the end of the sequence get the code 2**64-1.
+    """
+    if (k < 1) or (k > 31):
+        raise ValueError("kmer_codes only supports 1<=k<=31")
+    seqs = np.asarray(seqs)
+    if seqs.dtype.kind != "S":
+        seqs = seqs.astype(bytes)
+    X = seqs.view(np.uint8).reshape(len(seqs), -1)
+    if X.shape[1] < k:
+        return np.zeros((len(seqs), 0), dtype=np.uint64)
+    values = _base_to_2bit[X]
+    window_N = X.shape[1] - k + 1
+    codes = np.zeros((len(seqs), window_N), dtype=np.uint64)
+    invalid = np.zeros((len(seqs), window_N), dtype=bool)
+    for j in range(k):
+        v = values[:, j : j + window_N]
+        codes = (codes << np.uint64(2)) | (v & 3).astype(np.uint64)
+        invalid |= v > 3
+    codes[invalid] = np.iinfo(np.uint64).max
+    return codes
+
+
+def popcount(x):
+    """
+    Number of set bits of each element of an unsigned integer array
+    """
+    x = np.asarray(x)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).astype(np.int64)
+    bits = np.unpackbits(x.view(np.uint8).reshape(x.shape + (x.dtype.itemsize,)), axis=-1)
+    return bits.sum(-1).astype(np.int64)
+
+
+def encode_2bit(seqs):
+    """
+    Pack short DNA sequences (<=21 bp, e.g., cell barcodes and UMIs) into integers.
+
+    For a sequence of length L, bits [0, 2L) store the bases (A=0, C=1, G=2, T=3, first base highest),
+    bits [2L, 3L) store an N-mask (1 for N or any other character, whose base bits are 0),
+    and bit 3L is set as a length marker. The result is uint32 if all L<=10, and uint64 otherwise.
+
+    Two sequences are identical if and only if their codes are identical, so the codes
+    can be used directly for grouping and joins. Decode with decode_2bit.
+    """
+    seqs = np.asarray(seqs)
+    if seqs.dtype.kind != "S":
+        seqs = seqs.astype(bytes)
+    X = seqs.view(np.uint8).reshape(len(seqs), -1)
+    length = (X != 0).sum(1).astype(np.uint64)
+    if (len(seqs) > 0) and (length.max() > 21):
+        raise ValueError("encode_2bit only supports sequences up to 21 bp")
+
+    values = _base_to_2bit[X].astype(np.uint64)
+    shift = (length[:, np.newaxis] - 1 - np.arange(X.shape[1], dtype=np.uint64)).astype(
+        np.int64
+    )
+    inside = shift >= 0
+    shift = np.maximum(shift, 0).astype(np.uint64)
+    bases = np.where(inside & (values < 4), values << (2 * shift), 0)
+    n_mask = np.where(inside & (values == 4), np.uint64(1) << shift, 0)
+    codes = (
+        np.bitwise_or.reduce(bases.astype(np.uint64), axis=1)
+        | (np.bitwise_or.reduce(n_mask.astype(np.uint64), axis=1) << (2 * length))
+        | (np.uint64(1) << (3 * length))
+    )
+    if (len(seqs) == 0) or (length.max() <= 10):
+        return codes.astype(np.uint32)
+    return codes
+
+
+def length_2bit(codes):
+    """
+    Sequence length of each code from encode_2bit
+    """
+    codes = np.asarray(codes).astype(np.uint64)
+    length = np.zeros(len(codes), dtype=np.int64)
+    for k in range(1, 22):
+        length += (codes >> np.uint64(3 * k)) > 0
+    return length
+
+
+def decode_2bit(codes):
+    """
+    Decode the integers from encode_2bit back to a string array
+    """
+    codes = np.asarray(codes).astype(np.uint64)
+    length = length_2bit(codes)
+    width = max(1, int(length.max())) if len(codes) > 0 else 1
+    shift = length[:, np.newaxis] - 1 - np.arange(width)
+    inside = shift >= 0
+    shift = np.maximum(shift, 0).astype(np.uint64)
+    bases = (codes[:, np.newaxis] >> (2 * shift)) & np.uint64(3)
+    is_N = (codes[:, np.newaxis] >> (2 * length[:, np.newaxis].astype(np.uint64) + shift)) & np.uint64(1)
+    X = np.frombuffer(b"ACGT", dtype=np.uint8)[bases]
+    X[is_N > 0] = ord("N")
+    X[~inside] = 0
+    return X.view(f"S{width}").ravel().astype(str)
+
+
+def symbols_2bit(codes, L):
+    """
+    Bases of codes from encode_2bit, all of length L, as a (n, L) uint8 matrix
+    (0-3 for A, C, G, T, 4 for N), computed on the integers (the last base comes first)
+    """
+    codes = np.asarray(codes).astype(np.uint64)[:, np.newaxis]
+    shift = np.arange(L, dtype=np.uint64)
+    bases = (codes >> (2 * shift)) & np.uint64(3)
+    is_N = (codes >> (np.uint64(2 * L) + shift)) & np.uint64(1)
+    return np.where(is_N > 0, 4, bases).astype(np.uint8)
+
+
+def _spread_bits(x):
+    """
+    Move bit j of each 32-bit value to bit 2j
+    """
+    x = x & np.uint64(0xFFFFFFFF)
+    for shift, mask in [
+        (16, 0x0000FFFF0000FFFF),
+        (8, 0x00FF00FF00FF00FF),
+        (4, 0x0F0F0F0F0F0F0F0F),
+        (2, 0x3333333333333333),
+        (1, 0x5555555555555555),
+    ]:
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def bitplanes_2bit(codes, L):
+    """
+    Bit-planes of codes from encode_2bit, all of length L, for hamming_distance_bitplanes,
+    computed on the integers without decoding: the low bit and the high bit of each base,
+    and the N-mask, each with position j at bit 2j. After XOR, a position differs if
+    any plane differs there, so that N only matches N.
+
+    Returns a (n, 3, 1) uint64 array.
+    """
+    codes = np.asarray(codes).astype(np.uint64)
+    even = np.uint64(int("01" * L, 2) if L > 0 else 0)
+    n_mask = (codes >> np.uint64(2 * L)) & np.uint64((1 << L) - 1)
+    planes = np.stack(
+        [codes & even, (codes >> np.uint64(1)) & even, _spread_bits(n_mask)], axis=1
+    )
+    return planes[:, :, np.newaxis]
+
+
+def approximate_search(seqs, pattern, start=0, stop=None, from_end=False, prefer="left"):
+    """
+    Bit-parallel approximate search (Myers 1999) of a short pattern (<=64 bp) in a batch of
+    sequences, allowing mismatches and indels. The bit vectors of all sequences are updated
+    together, one text position at a time, so there is no python loop over sequences.
+
+    seqs:
+        A fixed-width byte array (dtype 'S'), or a list of str/bytes. 'N' matches nothing.
+    start, stop:
+        Only report matches at positions within [start, stop]. Scalars, or one value per sequence.
+        Default: the whole sequence.
+    from_end:
+        If False, the position of a match is its end (exclusive). If True, the sequences are scanned
+        backward with the reversed pattern, and the position of a match is its start.
+    prefer:
+        'left' or 'right': which position to report among equally good matches. Ties are first broken
+        in favor of a match with substitutions only (a window of len(pattern)), so that a mutated
+        first or last base is not reported as a deletion or insertion at the primer boundary.
+
+    Returns (distance, position): the smallest edit distance between the pattern and a substring of
+    each sequence, and the position of the preferred best match (-1, with distance len(pattern)+1,
+    if no position is allowed).
+    """
+    seqs = np.asarray(seqs)
+    if seqs.dtype.kind != "S":
+        seqs = seqs.astype(bytes)
+    if isinstance(pattern, str):
+        pattern = pattern.encode()
+    m = len(pattern)
+    if (m == 0) or (m > 64):
+        raise ValueError("approximate_search only supports patterns of 1-64 bp")
+    if prefer not in ["left", "right"]:
+        raise ValueError("prefer should be among {'left', 'right'}")
+    # scanning backward, later steps are further left
+    later_wins = (prefer == "right") != from_end
+
+    n = len(seqs)
+    X = seqs.view(np.uint8).reshape(n, seqs.dtype.itemsize)
+    length = (X != 0).sum(1)
+    start = np.broadcast_to(start, n)
+    stop = length if stop is None else np.broadcast_to(stop, n)
+    if from_end:
+        pattern = pattern[::-1]
+        idx = length[:, np.newaxis] - 1 - np.arange(X.shape[1])
+        X = np.where(idx >= 0, np.take_along_axis(X, np.maximum(idx, 0), axis=1), 0)
+
+    pattern_array = np.frombuffer(pattern, dtype=np.uint8)
+    peq = np.zeros(256, dtype=np.uint64)
+    for j, c in enumerate(pattern):
+        peq[c] |= np.uint64(1 << j)
+    mask = np.uint64((1 << m) - 1)
+    high = np.uint64(1 << (m - 1))
+    one = np.uint64(1)
+
+    Pv = np.full(n, mask, dtype=np.uint64)
+    Mv = np.zeros(n, dtype=np.uint64)
+    score = np.full(n, m, dtype=np.int64)
+    distance = np.full(n, m + 1, dtype=np.int64)
+    position = np.full(n, -1, dtype=np.int64)
+    substitution = np.zeros(n, dtype=bool)
+    for j in range(X.shape[1]):
+        Eq = peq[X[:, j]]
+        Xv = Eq | Mv
+        Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+        Ph = Mv | (~(Xh | Pv) & mask)
+        Mh = Pv & Xh
+        score += (Ph & high) > 0
+        score -= (Mh & high) > 0
+        Ph = (Ph << one) & mask
+        Mh = (Mh << one) & mask
+        Pv = Mh | (~(Xv | Ph) & mask)
+        Mv = Ph & Xv
+
+        pos = length - 1 - j if from_end else np.full(n, j + 1)
+        allowed = (j < length) & (pos >= start) & (pos <= stop) & (score <= distance)
+        # whether the window of m bases ending here explains the score by substitutions only
+        sub = np.zeros(n, dtype=bool)
+        if j + 1 >= m:
+            rows = np.nonzero(allowed)[0]
+            sub[rows] = (X[rows, j + 1 - m : j + 1] != pattern_array).sum(1) == score[rows]
+        tie = (score == distance) & (
+            (sub & ~substitution) | ((sub == substitution) & later_wins)
+        )
+        better = allowed & ((score < distance) | tie)
+        distance[better] = score[better]
+        position[better] = pos[better]
+        substitution[better] = sub[better]
+    return distance, position
+
+
 def order_sample_by_fates(sample_list):
     # a reference order, capitalized
     sample_order_0 = [
@@ -108,3 +465,391 @@ def order_sample_by_fates(sample_list):
     df = pd.DataFrame({"sample": sample_list, "lineage_order": order_list})
     df["mouse"] = df["sample"].apply(lambda x: x.split("-")[0])
     return df.sort_values(["mouse", "lineage_order"], ascending=True)["sample"].values
+
+
+def map_bounded(
+    fn, args_list, n_jobs=4, executor=None, max_concurrent=None, progress_bar=True
+):
+    """
+    Run fn(*args) for each args of args_list in worker processes, with at most max_concurrent
+    tasks submitted at a time (to bound the memory), and return the results in order.
+
+    Parameters
+    ----------
+    n_jobs:
+        Number of worker processes, if executor is not provided
+    executor:
+        An existing concurrent.futures executor to share across calls. It is not shut down here.
+        By default, a ProcessPoolExecutor with n_jobs workers is created and shut down.
+    max_concurrent:
+        Default: n_jobs
+    """
+    if max_concurrent is None:
+        max_concurrent = n_jobs
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return map_bounded(
+                fn,
+                args_list,
+                executor=executor,
+                max_concurrent=max_concurrent,
+                progress_bar=progress_bar,
+            )
+
+    results = {}
+    queue = list(enumerate(args_list))
+    running = {}
+    with tqdm(total=len(queue), disable=not progress_bar) as progress:
+        while (len(queue) > 0) or (len(running) > 0):
+            while (len(queue) > 0) and (len(running) < max_concurrent):
+                j, args = queue.pop(0)
+                running[executor.submit(fn, *args)] = j
+            done, __ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+                progress.update(1)
+    return [results[j] for j in range(len(args_list))]
+
+
+############################
+
+# fastq I/O on byte arrays
+
+############################
+
+
+def _bgzf_block_size(buffer, offset):
+    """
+    Size of the BGZF block (a gzip member with a 'BC' extra field) starting at offset,
+    or None if the gzip member there does not record its size.
+    """
+    if buffer[offset : offset + 4] != b"\x1f\x8b\x08\x04":  # gzip magic with FEXTRA
+        return None
+    xlen = int.from_bytes(buffer[offset + 10 : offset + 12], "little")
+    pos = offset + 12
+    while pos + 4 <= offset + 12 + xlen:
+        slen = int.from_bytes(buffer[pos + 2 : pos + 4], "little")
+        if (buffer[pos : pos + 2] == b"BC") and (slen == 2):
+            return int.from_bytes(buffer[pos + 4 : pos + 6], "little") + 1
+        pos += 4 + slen
+    return None
+
+
+def _inflate_blocks(buffer, blocks):
+    """
+    Decompress a list of (start, end) gzip members of buffer. zlib releases the GIL,
+    so this runs in parallel across threads.
+    """
+    return b"".join(zlib.decompress(buffer[start:end], 31) for start, end in blocks)
+
+
+def _inflate_members(buffer, offset, chunk_size=2 ** 20):
+    """
+    Decompress the gzip members of buffer from offset on, sequentially and in chunks
+    (for members that do not record their size)
+    """
+    while offset < len(buffer):
+        decompressor = zlib.decompressobj(31)
+        while not decompressor.eof:
+            if offset >= len(buffer):
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            data = buffer[offset : offset + chunk_size]
+            yield decompressor.decompress(data)
+            offset += len(data) - len(decompressor.unused_data)
+
+
+class _ParallelGzipReader(io.RawIOBase):
+    """
+    Read a BGZF file (multi-member gzip where each member records its compressed size,
+    e.g., from bgzip) by decompressing chunks of members in a thread pool, while keeping
+    the output order. From the first member that does not record its size (e.g., a plain
+    gzip file concatenated after a BGZF file), the rest is decompressed sequentially.
+    Use through open_fastq.
+    """
+
+    def __init__(self, file_name, n_threads=None, chunk_blocks=64):
+        super().__init__()
+        if n_threads is None:
+            n_threads = min(8, os.cpu_count() or 1)
+        self._file = open(file_name, "rb")
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._executor = ThreadPoolExecutor(n_threads)
+        self._futures = deque()
+        self._chunks = self._decompress_chunks(file_name, n_threads, chunk_blocks)
+        self._data = memoryview(b"")
+
+    def _decompress_chunks(self, file_name, n_threads, chunk_blocks):
+        offset = 0
+        blocks = []
+        while (offset < len(self._buffer)) or (len(blocks) > 0):
+            if offset < len(self._buffer):
+                size = _bgzf_block_size(self._buffer, offset)
+                if size is None:
+                    # return the pending chunks in order, then read the rest sequentially
+                    if len(blocks) > 0:
+                        self._futures.append(
+                            self._executor.submit(_inflate_blocks, self._buffer, blocks)
+                        )
+                    while len(self._futures) > 0:
+                        yield self._futures.popleft().result()
+                    yield from _inflate_members(self._buffer, offset)
+                    return
+                blocks.append((offset, offset + size))
+                offset += size
+            if (len(blocks) == chunk_blocks) or (offset >= len(self._buffer)):
+                self._futures.append(
+                    self._executor.submit(_inflate_blocks, self._buffer, blocks)
+                )
+                blocks = []
+            # keep a few chunks in flight per thread, and return them in order
+            while (len(self._futures) > 2 * n_threads) or (
+                (offset >= len(self._buffer)) and (len(self._futures) > 0)
+            ):
+                yield self._futures.popleft().result()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._data) == 0:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._data = memoryview(chunk)
+        n = min(len(b), len(self._data))
+        b[:n] = self._data[:n]
+        self._data = self._data[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._futures:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._data.release()
+            self._buffer.close()
+            self._file.close()
+        super().close()
+
+
+def open_fastq(file_name, n_threads=None):
+    """
+    Open a fastq file in binary mode, decompressing it if it ends with .gz
+
+    BGZF files (e.g., compressed with `bgzip -@ 8`) are decompressed in parallel
+    blocks across n_threads threads (default: up to 8). BGZF is detected from the first
+    member; if a later member does not record its size (e.g., `cat` of a BGZF and a plain
+    gzip file), the rest of the file is decompressed sequentially.
+
+    Plain gzip files, including multi-member ones, do not record where their members end,
+    which is only known after decompressing them, so they are read sequentially with gzip.open.
+    """
+    if str(file_name).endswith(".gz"):
+        with open(file_name, "rb") as f:
+            header = f.read(18)
+        if _bgzf_block_size(header, 0) is not None:
+            return io.BufferedReader(
+                _ParallelGzipReader(file_name, n_threads), buffer_size=2 ** 20
+            )
+        return gzip.open(file_name, "rb")
+    else:
+        return open(file_name, "rb")
+
+
+def _strip_line_ends(lines):
+    """
+    Remove the trailing newline of each element in a fixed-width byte array.
+    The newline is replaced with the padding byte b'\\x00', and the array is
+    then trimmed to the longest remaining element.
+    """
+    if len(lines) == 0:
+        return lines.astype("S1")
+    X = lines.view(np.uint8).reshape(len(lines), -1)
+    X[(X == 10) | (X == 13)] = 0
+    width = max(1, int((X != 0).sum(1).max()))
+    return lines.astype(f"S{width}")
+
+
+def read_fastq_batches(file_name, batch_size=1000000):
+    """
+    Stream a fastq file (plain or gzipped) as batches of `batch_size` records,
+    so that the peak memory depends on the batch size, not on the file size.
+
+    Each batch is a dict with:
+        'name': read names (the header without '@' and the comment after the first space)
+        'seq': sequences, a np.array of dtype 'S{max_length}'
+        'quality': raw phred+33 quality strings, a np.array of dtype 'S{max_length}'
+
+    Fixed-width byte arrays are padded with b'\\x00' at the end, so that
+    `x.view(np.uint8).reshape(len(x), -1)` gives a padded uint8 matrix without copying.
+    """
+    with open_fastq(file_name) as handle:
+        while True:
+            lines = list(itertools.islice(handle, 4 * batch_size))
+            if len(lines) == 0:
+                break
+            if len(lines) % 4 != 0:
+                raise ValueError(f"{file_name}: the last fastq record is truncated")
+
+            header = _strip_line_ends(np.array(lines[0::4]))
+            if np.any(header.astype("S1") != b"@"):
+                raise ValueError(f"{file_name}: fastq header does not start with '@'")
+            names = np.char.partition(header, b" ")[:, 0]
+            yield {
+                "name": np.char.lstrip(names, b"@"),
+                "seq": _strip_line_ends(np.array(lines[1::4])),
+                "quality": _strip_line_ends(np.array(lines[3::4])),
+            }
+
+
+def _read_name_stem(names):
+    """
+    Drop the mate suffix ('/1' or '/2') used by older Illumina read names
+    """
+    mate_idx = np.nonzero(
+        np.char.endswith(names, b"/1") | np.char.endswith(names, b"/2")
+    )[0]
+    if len(mate_idx) == 0:
+        return names
+    names = names.copy()
+    X = names.view(np.uint8).reshape(len(names), -1)
+    name_length = np.char.str_len(names[mate_idx])
+    X[mate_idx, name_length - 1] = 0
+    X[mate_idx, name_length - 2] = 0
+    return names
+
+
+def read_paired_fastq_batches(file_name_seq, file_name_tag, batch_size=1000000):
+    """
+    Walk a pair of fastq files (e.g., R1 and R2 from the same run) in lockstep, and
+    yield batches of `batch_size` paired records.
+
+    Each batch is a dict with 'name', 'seq', 'seq_quality', 'tag', 'tag_quality',
+    where 'seq' comes from file_name_seq and 'tag' from file_name_tag.
+    See read_fastq_batches for the format of each field.
+
+    The read names are checked batch by batch, so that mismatched files
+    fail at the first inconsistent read, instead of after parsing the whole run.
+    """
+    batches = itertools.zip_longest(
+        read_fastq_batches(file_name_seq, batch_size),
+        read_fastq_batches(file_name_tag, batch_size),
+    )
+    for j, (batch_seq, batch_tag) in enumerate(batches):
+        if (
+            (batch_seq is None)
+            or (batch_tag is None)
+            or (len(batch_seq["seq"]) != len(batch_tag["seq"]))
+        ):
+            raise ValueError(
+                f"{file_name_seq} and {file_name_tag} have different number of reads"
+            )
+
+        mismatch_idx = np.nonzero(
+            _read_name_stem(batch_seq["name"]) != _read_name_stem(batch_tag["name"])
+        )[0]
+        if len(mismatch_idx) > 0:
+            k = mismatch_idx[0]
+            raise ValueError(
+                f"Read names do not match at read {j*batch_size+k}: "
+                f"{batch_seq['name'][k].decode()} ({file_name_seq}) vs "
+                f"{batch_tag['name'][k].decode()} ({file_name_tag})"
+            )
+
+        yield {
+            "name": batch_seq["name"],
+            "seq": batch_seq["seq"],
+            "seq_quality": batch_seq["quality"],
+            "tag": batch_tag["seq"],
+            "tag_quality": batch_tag["quality"],
+        }
+
+
+def read_fastq_mmap(file_name, batch_size=1000000):
+    """
+    Memory-map an uncompressed fastq file (e.g., the PEAR-assembled bulk reads), and yield
+    windows of up to `batch_size` complete records. Record boundaries are found by
+    a vectorized newline search over each window of the mapped file.
+
+    Each window is a dict with:
+        'buffer': a uint8 view of the whole mapped file (zero copy)
+        'seq_start', 'quality_start': offsets of the sequence and quality of each record in 'buffer'
+        'length': the sequence (and quality) length of each record
+
+    So, the sequence of record j is buffer[seq_start[j]:seq_start[j]+length[j]], a view into the file.
+    Use gather_fastq_window to get padded byte arrays as from read_fastq_batches.
+    """
+    file_size = os.path.getsize(file_name)
+    if file_size == 0:
+        return
+    with open(file_name, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buffer = np.frombuffer(mm, dtype=np.uint8)
+
+    pos = 0
+    window = 2 ** 20
+    while pos < file_size:
+        end = min(pos + window, file_size)
+        newline = np.flatnonzero(buffer[pos:end] == 10) + pos
+        if (end == file_size) and ((len(newline) == 0) or (newline[-1] != file_size - 1)):
+            newline = np.append(newline, file_size)  # the last line has no newline
+        record_N = min(len(newline) // 4, batch_size)
+        if record_N == 0:
+            if end == file_size:
+                if np.any(buffer[pos:] > 32):
+                    raise ValueError(f"{file_name}: the last fastq record is truncated")
+                break
+            window = window * 2
+            continue
+        newline = newline[: 4 * record_N]
+
+        header_start = np.append(pos, newline[3::4][:-1] + 1)
+        line_end = newline.copy()
+        line_end[buffer[np.maximum(newline - 1, 0)] == 13] -= 1  # windows line ends
+        seq_start = newline[0::4] + 1
+        quality_start = newline[2::4] + 1
+        length = line_end[1::4] - seq_start
+        if np.any(buffer[header_start] != ord("@")) or np.any(
+            buffer[newline[1::4] + 1] != ord("+")
+        ):
+            raise ValueError(f"{file_name}: invalid fastq record near byte {pos}")
+        if np.any(line_end[3::4] - quality_start != length):
+            raise ValueError(f"{file_name}: sequence and quality lengths differ")
+
+        yield {
+            "buffer": buffer,
+            "seq_start": seq_start,
+            "quality_start": quality_start,
+            "length": length,
+        }
+        pos = newline[-1] + 1
+        if (record_N < batch_size) and (end < file_size):
+            window = window * 2
+
+
+def _gather_byte_array(buffer, start, length):
+    """
+    Copy buffer[start[j]:start[j]+length[j]] for all j into a padded byte array (dtype 'S'),
+    through a strided view of the buffer instead of a python loop
+    """
+    width = max(1, int(length.max()))
+    X = np.zeros((len(start), width), dtype=np.uint8)
+    safe = start <= len(buffer) - width
+    X[safe] = np.lib.stride_tricks.sliding_window_view(buffer, width)[start[safe]]
+    for j in np.nonzero(~safe)[0]:  # only the last few records of the file
+        X[j, : length[j]] = buffer[start[j] : start[j] + length[j]]
+    X[np.arange(width) >= length[:, np.newaxis]] = 0
+    return X.view(f"S{width}").ravel()
+
+
+def gather_fastq_window(window):
+    """
+    Convert a window from read_fastq_mmap into a batch dict with padded 'seq' and
+    'quality' byte arrays, the same format as read_fastq_batches (without 'name')
+    """
+    return {
+        "seq": _gather_byte_array(window["buffer"], window["seq_start"], window["length"]),
+        "quality": _gather_byte_array(
+            window["buffer"], window["quality_start"], window["length"]
+        ),
+    }
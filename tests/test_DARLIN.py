@@ -0,0 +1,436 @@
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mosaiclineage import DARLIN, larry, util
+
+rng = np.random.default_rng(0)
+
+
+def random_seq(n):
+    return "".join(rng.choice(list("ACGT"), size=n))
+
+
+def random_quality(n):
+    return "".join(chr(33 + x) for x in rng.integers(2, 41, size=n))
+
+
+def write_sc10xV3_fastq(data_path, sample="S1", read_N=500):
+    """
+    Write a pair of small sc10xV3 fastq files: the tag (cell barcode + UMI) in R1, and
+    the CARLIN amplicon in R2
+    """
+    cell_bc_list = [random_seq(16) for _ in range(10)]
+    allele_list = [
+        DARLIN.CA_CARLIN,
+        DARLIN.CA_CARLIN[:50] + DARLIN.CA_CARLIN[80:],
+        DARLIN.CA_CARLIN[:10] + DARLIN.CA_CARLIN[200:],
+    ]
+    with gzip.open(f"{data_path}/{sample}_R1.fastq.gz", "wt") as f_tag, gzip.open(
+        f"{data_path}/{sample}_R2.fastq.gz", "wt"
+    ) as f_seq:
+        for j in range(read_N):
+            tag = rng.choice(cell_bc_list) + random_seq(12) + "TTTT"
+            seq = (
+                DARLIN.CA_5prime_full + rng.choice(allele_list) + DARLIN.CA_3prime
+            )[:300]
+            f_tag.write(f"@read{j} 1:N:0\n{tag}\n+\n{random_quality(len(tag))}\n")
+            f_seq.write(f"@read{j} 2:N:0\n{seq}\n+\n{random_quality(len(seq))}\n")
+
+
+def write_bulk_fastq(data_path, sample="S1", read_N=500):
+    """
+    Write a small PEAR-assembled bulk fastq file: 12 bp UMI + reverse complement of the amplicon
+    """
+    with open(f"{data_path}/{sample}.trimmed.pear.assembled.fastq", "w") as f:
+        for j in range(read_N):
+            CARLIN = DARLIN.CA_CARLIN[: rng.integers(200, 276)]
+            seq = random_seq(12) + util.reverse_compliment(
+                DARLIN.CA_5prime_full + CARLIN + DARLIN.CA_3prime
+            )
+            f.write(f"@read{j}\n{seq}\n+\n{random_quality(len(seq))}\n")
+
+
+def compare_tables(df_1, df_2):
+    assert list(df_1.columns) == list(df_2.columns)
+    for key in df_1.columns:
+        if df_1[key].dtype.kind in "fiu":
+            assert np.allclose(df_1[key].astype(float), df_2[key].astype(float))
+        else:
+            assert (df_1[key].astype(str).values == df_2[key].astype(str).values).all()
+
+
+def test_read_fastq_batches(tmp_path):
+    write_sc10xV3_fastq(tmp_path, read_N=25)
+    batches = list(util.read_fastq_batches(f"{tmp_path}/S1_R1.fastq.gz", batch_size=10))
+    assert [len(x["seq"]) for x in batches] == [10, 10, 5]
+    assert batches[0]["name"][0] == b"read0"
+    assert batches[0]["seq"].dtype == np.dtype("S32")
+
+
+def test_open_fastq_bgzf(tmp_path):
+    from Bio import bgzf
+
+    write_sc10xV3_fastq(tmp_path, read_N=2000)
+    with gzip.open(f"{tmp_path}/S1_R2.fastq.gz", "rb") as f:
+        raw = f.read()
+    with bgzf.BgzfWriter(f"{tmp_path}/S2_R2.fastq.gz", "wb") as f:
+        f.write(raw)
+    with util.open_fastq(f"{tmp_path}/S2_R2.fastq.gz", n_threads=2) as f:
+        assert not isinstance(f, gzip.GzipFile)
+        assert f.read() == raw
+    with util.open_fastq(f"{tmp_path}/S1_R2.fastq.gz") as f:
+        assert isinstance(f, gzip.GzipFile)
+        assert list(f) == raw.splitlines(keepends=True)
+
+    # a BGZF file followed by a plain gzip member, as from cat
+    with open(f"{tmp_path}/S3_R2.fastq.gz", "wb") as f:
+        for name in ["S2_R2", "S1_R2", "S2_R2"]:
+            with open(f"{tmp_path}/{name}.fastq.gz", "rb") as f_in:
+                f.write(f_in.read())
+    with util.open_fastq(f"{tmp_path}/S3_R2.fastq.gz", n_threads=2) as f:
+        assert not isinstance(f, gzip.GzipFile)
+        assert f.read() == raw * 3
+
+
+def test_CARLIN_raw_reads_batch_mode(tmp_path):
+    write_sc10xV3_fastq(tmp_path)
+    df_ref = DARLIN.CARLIN_raw_reads(tmp_path, "S1", protocol="sc10xV3")
+    df_batch = DARLIN.CARLIN_raw_reads(
+        tmp_path, "S1", protocol="sc10xV3", batch_size=128
+    )
+    compare_tables(df_ref, df_batch[df_ref.columns])
+    for key in ["cell_bc_quality_min", "umi_quality_min", "clone_id_quality_min"]:
+        assert df_ref[key].dtype == df_batch[key].dtype == np.float64
+
+
+def test_read_paired_fastq_batches_mismatch(tmp_path):
+    write_sc10xV3_fastq(tmp_path, read_N=20)
+    with gzip.open(f"{tmp_path}/S1_R1.fastq.gz", "rt") as f:
+        lines = f.readlines()
+    lines[4 * 12] = "@read_x 1:N:0\n"
+    with gzip.open(f"{tmp_path}/S1_R1.fastq.gz", "wt") as f:
+        f.writelines(lines)
+
+    batches = util.read_paired_fastq_batches(
+        f"{tmp_path}/S1_R2.fastq.gz", f"{tmp_path}/S1_R1.fastq.gz", batch_size=5
+    )
+    assert len(next(batches)["tag"]) == 5
+    with pytest.raises(ValueError, match="read 12"):
+        list(batches)
+
+
+def test_CARLIN_raw_reads_bulk_batch_mode(tmp_path):
+    write_bulk_fastq(tmp_path)
+    df_ref = DARLIN.CARLIN_raw_reads(tmp_path, "S1", protocol="BulkRNA_12UMI")
+    df_batch = DARLIN.CARLIN_raw_reads(
+        tmp_path, "S1", protocol="BulkRNA_12UMI", batch_size=128
+    )
+    compare_tables(df_ref, df_batch[df_ref.columns])
+    assert df_batch["clone_id"].str.startswith(DARLIN.CA_5prime_full).all()
+    for key in ["cell_bc_quality_min", "clone_id_quality_min"]:
+        assert df_ref[key].dtype == df_batch[key].dtype == np.float64
+
+    # a read of only a UMI has an empty CARLIN segment, which does not change the dtype
+    with open(f"{tmp_path}/S1.trimmed.pear.assembled.fastq", "a") as f:
+        f.write(f"@read_umi\n{random_seq(12)}\n+\n{random_quality(12)}\n")
+    df_ref = DARLIN.CARLIN_raw_reads(tmp_path, "S1", protocol="BulkRNA_12UMI")
+    df_batch = DARLIN.CARLIN_raw_reads(
+        tmp_path, "S1", protocol="BulkRNA_12UMI", batch_size=128
+    )
+    assert df_ref["clone_id_quality_min"].dtype == df_batch["clone_id_quality_min"].dtype == np.float64
+    assert np.isnan(df_batch["clone_id_quality_min"].iloc[-1])
+
+
+def test_CARLIN_raw_reads_aggregate(tmp_path):
+    write_sc10xV3_fastq(tmp_path)
+    df_reads = DARLIN.CARLIN_raw_reads(tmp_path, "S1", protocol="sc10xV3")
+    df_molecule = DARLIN.CARLIN_raw_reads(
+        tmp_path, "S1", protocol="sc10xV3", batch_size=64, aggregate=True
+    )
+    assert df_molecule["read"].sum() == len(df_reads)
+    assert not df_molecule.duplicated(["cell_bc", "umi", "clone_id"]).any()
+
+    key_list = ["cell_id", "umi", "clone_id"]
+    df_ref = (
+        DARLIN.CARLIN_preprocessing(df_reads)
+        .sort_values(key_list)
+        .reset_index(drop=True)
+    )
+    df_new = (
+        DARLIN.CARLIN_preprocessing(df_molecule)
+        .sort_values(key_list)
+        .reset_index(drop=True)
+    )
+    compare_tables(df_ref, df_new[df_ref.columns])
+
+
+def test_load_raw_reads_across_samples(tmp_path):
+    write_sc10xV3_fastq(tmp_path, sample="S1", read_N=100)
+    write_sc10xV3_fastq(tmp_path, sample="S2", read_N=50)
+    df_all, df_report = DARLIN.load_raw_reads_across_samples(
+        tmp_path, ["S2", "S1"], n_jobs=2, protocol="sc10xV3", batch_size=32
+    )
+    assert list(df_all["library"].unique()) == ["S2", "S1"]
+    assert df_report["read"].to_list() == [50, 100]
+
+
+def test_encode_2bit():
+    seqs = np.array(["ACGTACGTACGTACGT", "ACGTACGTACGTACGA", "ACGTNCGTACGTACGT", "ACG"])
+    codes = util.encode_2bit(seqs)
+    assert codes.dtype == np.uint64
+    assert len(set(codes)) == 4
+    assert (util.decode_2bit(codes) == seqs).all()
+
+
+def test_CARLIN_raw_reads_packed(tmp_path):
+    write_sc10xV3_fastq(tmp_path)
+    df_ref = DARLIN.CARLIN_preprocessing(
+        DARLIN.CARLIN_raw_reads(tmp_path, "S1", protocol="sc10xV3")
+    )
+    df_packed = DARLIN.CARLIN_raw_reads(
+        tmp_path, "S1", protocol="sc10xV3", batch_size=64, aggregate=True, packed=True
+    )
+    assert df_packed["cell_bc"].dtype == np.uint64
+    assert "cell_id" not in df_packed.columns
+    df_new = larry.unpack_barcodes(DARLIN.CARLIN_preprocessing(df_packed))
+
+    key_list = ["cell_id", "umi", "clone_id"]
+    df_ref = df_ref.sort_values(key_list).reset_index(drop=True)
+    df_new = df_new.sort_values(key_list).reset_index(drop=True)
+    compare_tables(df_ref, df_new[df_ref.columns])
+
+
+def random_CARLIN_reads(read_N=400, templates=["cCARLIN"]):
+    """
+    A raw read table as from CARLIN_raw_reads: a few cells, reused umis and alleles, and
+    reads with a mutated primer or no CARLIN at all
+    """
+    primers = {
+        "cCARLIN": (DARLIN.CA_5prime_full, DARLIN.CA_CARLIN, DARLIN.CA_3prime),
+        "Tigre": (DARLIN.TA_5prime_full, DARLIN.TA_CARLIN, DARLIN.TA_3prime),
+        "Rosa": (DARLIN.RA_5prime_full, DARLIN.RA_CARLIN, DARLIN.RA_3prime),
+    }
+    cell_bc_list = [random_seq(16) for _ in range(8)]
+    umi_list = [random_seq(12) for _ in range(20)]
+    seqs = []
+    for template in templates:
+        seq_5prime, CARLIN, seq_3prime = primers[template]
+        for allele in [CARLIN, CARLIN[:50] + CARLIN[80:], CARLIN[:10] + CARLIN[200:]]:
+            seq = seq_5prime + allele + seq_3prime
+            seqs.append(seq[:300])
+            j = len(seq_5prime) - 3
+            seqs.append((seq[:j] + ("A" if seq[j] != "A" else "C") + seq[j + 1 :])[:300])
+    seqs += [random_seq(300) for _ in range(3)]
+    df = pd.DataFrame(
+        {
+            "cell_bc": rng.choice(cell_bc_list, size=read_N),
+            "umi": rng.choice(umi_list, size=read_N),
+            "clone_id": rng.choice(seqs, size=read_N),
+            "library": "S1",
+        }
+    )
+    df["cell_id"] = df["library"] + "_" + df["cell_bc"]
+    df["umi_id"] = df["cell_bc"] + "_" + df["umi"]
+    return df
+
+
+def test_CARLIN_preprocessing_collapse_sequences():
+    df = random_CARLIN_reads()
+    for max_edits in [0, 1]:
+        kwargs = dict(seq_5prime_max_edits=max_edits, seq_3prime_max_edits=max_edits)
+        df_ref = DARLIN.CARLIN_preprocessing(df, collapse_sequences=False, **kwargs)
+        df_new = DARLIN.CARLIN_preprocessing(df, collapse_sequences=True, **kwargs)
+        assert len(df_ref) > 0
+        assert df_new.equals(df_ref)
+
+
+def group_molecules_by_unique_id(df_output):
+    """
+    Reference: the former grouping of CARLIN_preprocessing, on a concatenated string key
+    """
+    df_output = df_output.copy()
+    df_output["unique_id"] = (
+        df_output["cell_id"] + "_" + df_output["umi_id"] + "_" + df_output["clone_id"]
+    )
+    df_tmp = (
+        df_output.groupby("unique_id").agg(read=("unique_id", "count")).reset_index()
+    )
+    return (
+        df_output.filter(
+            [
+                "cell_bc",
+                "library",
+                "cell_id",
+                "umi",
+                "umi_id",
+                "clone_id",
+                "unique_id",
+                "Valid",
+                "3prime_detected",
+            ]
+        )
+        .merge(df_tmp, on="unique_id")
+        .drop(["Valid", "unique_id"], axis=1)
+        .drop_duplicates()
+    )
+
+
+def test_group_molecules():
+    df = random_CARLIN_reads(read_N=600)
+    df["library"] = rng.choice(["S1", "S2"], size=len(df))
+    df["cell_id"] = df["library"] + "_" + df["cell_bc"]
+    df["clone_id"] = rng.choice(["ACGT", "ACG", "TTTT"], size=len(df))
+    df["3prime_detected"] = rng.random(len(df)) < 0.8
+    df["Valid"] = True
+    df["read"] = 1
+    df_ref = group_molecules_by_unique_id(df).reset_index(drop=True)
+    df_new = DARLIN._group_molecules(df)
+    compare_tables(df_ref, df_new[df_ref.columns])
+    assert df_new["read"].dtype == np.int64
+
+    df_packed = larry.unpack_barcodes(DARLIN._group_molecules(larry.pack_barcodes(df)))
+    compare_tables(df_ref, df_packed[df_ref.columns])
+
+
+def test_extract_CARLIN_sequences():
+    seq_5prime, seq_3prime = DARLIN.CA_5prime, DARLIN.CA_3prime[:10]
+    seq_full = DARLIN.CA_5prime_full + DARLIN.CA_CARLIN + DARLIN.CA_3prime
+    seqs = [
+        seq_full,
+        seq_full[:200],
+        seq_full + seq_5prime + "ACGT",
+        seq_3prime + seq_full[:250],
+        random_seq(250),
+    ]
+    df = DARLIN.extract_CARLIN_sequences(seqs, seq_5prime, seq_3prime, "", seq_full, 10)
+    for j, x in enumerate(seqs):
+        assert df["Valid_5prime"][j] == (seq_5prime in x)
+        assert df["Valid_3prime_0"][j] == (seq_3prime in x)
+        assert df["Valid_3prime_1"][j] == (x[-10:] in seq_full)
+        if seq_5prime in x:
+            CARLIN = x.split(seq_5prime)[1]
+            if seq_3prime in x:
+                CARLIN = CARLIN.split(seq_3prime)[0]
+            assert df["clone_id"][j] == CARLIN
+
+
+def test_approximate_primer_matching():
+    seq_5prime, seq_3prime = DARLIN.CA_5prime, DARLIN.CA_3prime[:12]
+    seq_full = DARLIN.CA_5prime_full + DARLIN.CA_CARLIN + DARLIN.CA_3prime
+    CARLIN = DARLIN.CA_CARLIN[:100]
+    seqs = [
+        seq_5prime[:5] + "N" + seq_5prime[6:] + CARLIN + seq_3prime,  # mismatch
+        seq_5prime[:5] + seq_5prime[6:] + CARLIN + seq_3prime,  # deletion
+        seq_5prime + CARLIN + seq_3prime[:3] + "A" + seq_3prime[3:] + "ACGT",  # insertion
+    ]
+    df = DARLIN.extract_CARLIN_sequences(seqs, seq_5prime, seq_3prime, "", seq_full, 12)
+    assert not (df["Valid_5prime"] & df["Valid_3prime_0"]).any()
+
+    df = DARLIN.extract_CARLIN_sequences(
+        seqs, seq_5prime, seq_3prime, "", seq_full, 12, 1, 1
+    )
+    assert df["Valid_5prime"].all() and df["Valid_3prime_0"].all()
+    assert df["Recovered"].all()
+    assert (df["clone_id"] == CARLIN).all()
+
+    distance, position = util.approximate_search(seqs, seq_5prime)
+    assert distance.tolist() == [1, 1, 0]
+
+
+def test_approximate_primer_matching_boundary():
+    # a mutated first or last primer base must not move the CARLIN boundary
+    seq_5prime, seq_3prime = DARLIN.CA_5prime, DARLIN.CA_3prime[:12]
+    seq_full = DARLIN.CA_5prime_full + DARLIN.CA_CARLIN + DARLIN.CA_3prime
+    # the CARLIN starts with the last base of the 5 prime primer, and one of them ends with
+    # the first base of the 3 prime primer, which makes an indel at the boundary equally good
+    CARLIN_list = [DARLIN.CA_CARLIN[:100], DARLIN.CA_CARLIN[:99]]
+    assert CARLIN_list[0][0] == seq_5prime[-1]
+    assert CARLIN_list[1][-1] == seq_3prime[0]
+
+    def mutate(seq, j, base):
+        return seq[:j] + base + seq[j + 1 :] if j >= 0 else seq[:j] + base
+
+    seqs, expected = [], []
+    for CARLIN in CARLIN_list:
+        for j in [0, -1]:
+            for primer in ["5prime", "3prime"]:
+                primer_seq = seq_5prime if primer == "5prime" else seq_3prime
+                for base in "ACGT".replace(primer_seq[j], ""):
+                    if primer == "5prime":
+                        seqs.append(mutate(seq_5prime, j, base) + CARLIN + seq_3prime)
+                    else:
+                        seqs.append(seq_5prime + CARLIN + mutate(seq_3prime, j, base) + "ACGT")
+                    expected.append(CARLIN)
+    df = DARLIN.extract_CARLIN_sequences(
+        seqs, seq_5prime, seq_3prime, "", seq_full, 12, 1, 1
+    )
+    assert df["Recovered"].all()
+    assert df["clone_id"].tolist() == expected
+
+
+def test_assign_CARLIN_locus():
+    seqs = [
+        DARLIN.CA_5prime_full + DARLIN.CA_CARLIN + DARLIN.CA_3prime,
+        DARLIN.TA_5prime_full + DARLIN.TA_CARLIN[:100] + DARLIN.TA_3prime,
+        DARLIN.RA_5prime_full + DARLIN.RA_CARLIN[:200],
+        random_seq(300),
+    ]
+    locus = DARLIN.assign_CARLIN_locus(seqs)
+    assert locus.tolist() == ["cCARLIN", "Tigre", "Rosa", ""]
+
+
+def test_demultiplex_CARLIN_loci():
+    templates = ["cCARLIN", "Tigre", "Rosa"]
+    df = random_CARLIN_reads(read_N=900, templates=templates)
+    seq_5prime_full = [DARLIN.CA_5prime_full, DARLIN.TA_5prime_full, DARLIN.RA_5prime_full]
+    # reads with a mutated 5 prime anchor, or no CARLIN, are junk
+    locus = np.full(len(df), "", dtype=object)
+    for template, seq_5prime in zip(templates, seq_5prime_full):
+        locus[df["clone_id"].str.startswith(seq_5prime).to_numpy()] = template
+
+    df_dict, df_unassigned = DARLIN.demultiplex_CARLIN_loci(df, templates=templates)
+    assert list(df_dict.keys()) == templates
+    for template in templates:
+        df_ref = DARLIN.CARLIN_preprocessing(df[locus == template], template=template)
+        assert len(df_ref) > 0
+        assert df_dict[template].equals(df_ref)
+    assert (locus == "").sum() > 0
+    assert df_unassigned.equals(df[locus == ""])
+
+
+def test_batch_consensus_sequences():
+    seqs = ["ACGTA", "ACGTT", "ACCTA", "ACG", "GGNNC", "GGTT"]
+    groups = ["c1", "c1", "c1", "c1", "c2", "c2"]
+    weights = [3, 1, 1, 1, 1, 2]
+    consensus = DARLIN.batch_consensus_sequences(seqs, groups, weights)
+    assert consensus.to_dict() == {"c1": "ACGTA", "c2": "GGTT"}
+    # sequences of different lengths
+    assert DARLIN.consensus_sequence(pd.Series(["ACGT", "ACGTAA", "ACGA"])) == "ACGT"
+
+
+def test_CARLIN_analysis_across_partitions():
+    df = pd.DataFrame(
+        {
+            "library": np.repeat(["L1", "L2"], 100),
+            "cell_bc": [f"c{j}" for j in rng.integers(0, 30, size=200)],
+            "clone_id": rng.choice(["ACGT", "ACG", "AC"], size=200, p=[0.8, 0.1, 0.1]),
+            "read": rng.integers(1, 10, size=200),
+        }
+    )
+    df_ref = DARLIN.CARLIN_analysis(df.copy())
+    df_final, df_report = DARLIN.CARLIN_analysis_across_partitions(
+        df, partition="hash", n_partitions=3, n_jobs=2
+    )
+    assert df_final.equals(df_ref)
+    assert df_report["cell"].sum() == len(df_ref)
+
+    df_final, df_report = DARLIN.CARLIN_analysis_across_partitions(df, n_jobs=2)
+    assert df_report["partition"].to_list() == ["L1", "L2"]
+    assert set(df_final["library"]) == {"L1", "L2"}
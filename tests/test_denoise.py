@@ -0,0 +1,250 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pandas as pd
+
+from mosaiclineage import larry, util
+
+rng = np.random.default_rng(0)
+
+
+def test_obtain_read_dominant_sequences():
+    df = pd.DataFrame(
+        {
+            "cell_bc": ["c1", "c1", "c1", "c2", "c2", "c2", "c3"],
+            "umi": ["u1", "u2", "u3", "u1", "u2", "u3", "u1"],
+            "clone_id": ["AC", "AC", "ACGT", "AC", "ACG", "ACG", "A"],
+            "read": [2, 3, 4, 5, 2, 3, 1],
+        }
+    )
+    df_out = larry.obtain_read_dominant_sequences(df)
+    assert list(df_out.columns) == [
+        "cell_bc",
+        "umi",
+        "clone_id",
+        "seq_length",
+        "read",
+        "max_read_ratio",
+    ]
+    # c1: AC (5 reads) wins; c2: a tie between AC and ACG, both kept
+    assert df_out["umi"].to_list() == ["u1", "u2", "u1", "u2", "u3", "u1"]
+    assert df_out["read"].to_list() == [5, 5, 5, 5, 5, 1]
+    assert np.allclose(df_out["max_read_ratio"], [5 / 9, 5 / 9, 0.5, 0.5, 0.5, 1])
+    assert "seq_length" not in df.columns
+
+
+def random_barcodes(n_true, L, n, error_rate=0.7):
+    """
+    Draw n barcodes from n_true true barcodes, with Poisson substitution errors
+    """
+    true_list = ["".join(rng.choice(list("ACGT"), size=L)) for _ in range(n_true)]
+    seq_list = []
+    for _ in range(n):
+        seq = list(rng.choice(true_list))
+        for __ in range(rng.poisson(error_rate)):
+            seq[rng.integers(L)] = rng.choice(list("ACGT"))
+        seq_list.append("".join(seq))
+    return seq_list
+
+
+def greedy_Hamming_denoise(seq_list, distance_threshold):
+    """
+    Reference: merge the remaining sequences into the most abundant one, by brute force
+    """
+    df = pd.DataFrame({"seq": np.array(seq_list).astype(bytes), "read": 1})
+    df = df.groupby("seq").sum().reset_index().sort_values("read", ascending=False)
+    mapping = {}
+    for x in df["seq"]:
+        if x in mapping:
+            continue
+        for y in df["seq"]:
+            if (
+                (y not in mapping)
+                and (len(x) == len(y))
+                and (sum(a != b for a, b in zip(x, y)) <= distance_threshold)
+            ):
+                mapping[y] = x
+    return mapping
+
+
+def test_denoise_sequence_Hamming():
+    for L, distance_threshold in [(12, 1), (10, 2), (3, 4)]:
+        seq_list = random_barcodes(50, L, 1000)
+        mapping, new_seq_list = larry.denoise_sequence(
+            seq_list, distance_threshold=distance_threshold, progress_bar=False
+        )
+        assert mapping == greedy_Hamming_denoise(seq_list, distance_threshold)
+        assert len(new_seq_list) == len(seq_list)
+
+
+def test_denoise_sequence_Hamming_variable_length():
+    seq_list = random_barcodes(30, 12, 500) + random_barcodes(30, 10, 500)
+    seq_list += [x[:-1] for x in seq_list[:100]]
+    mapping, new_seq_list = larry.denoise_sequence(
+        seq_list, distance_threshold=1, progress_bar=False
+    )
+    assert mapping == greedy_Hamming_denoise(seq_list, 1)
+    assert all(len(x) == len(y) for x, y in zip(seq_list, new_seq_list))
+
+
+def test_denoise_sequence_Hamming_packed():
+    seq_list = random_barcodes(30, 12, 500) + random_barcodes(30, 10, 500)
+    seq_list += [x[:3] + "N" + x[4:] for x in seq_list[:50]]
+    codes = util.encode_2bit(np.array(seq_list).astype(bytes))
+    mapping, new_seq_list = larry.denoise_sequence(
+        seq_list, distance_threshold=1, progress_bar=False
+    )
+    mapping_packed, new_codes = larry.denoise_sequence(
+        codes, distance_threshold=1, progress_bar=False
+    )
+    assert new_codes.dtype == codes.dtype
+    assert len(mapping_packed) == len(mapping)
+    assert np.array_equal(util.decode_2bit(new_codes), np.array(new_seq_list).astype(str))
+
+
+def test_match_whitelist():
+    whiteList = ["AAAAAA", "AAAATT", "CCCCCC", "Lib1_GGGG", "Lib2_GGGG"]
+    seqs = ["AAAAAA", "AAAAAT", "CCCCCA", "GGGGGG", "Lib1_GGGC", "Lib3_GGGG", "CCC"]
+    df = larry.match_whitelist(seqs, whiteList, distance_threshold=1)
+    assert df["whitelist_seq"].to_list() == [
+        b"AAAAAA",
+        None,  # equally close to AAAAAA and AAAATT
+        b"CCCCCC",
+        None,
+        b"Lib1_GGGG",
+        None,  # equally close to Lib1_GGGG and Lib2_GGGG
+        None,
+    ]
+    assert df["match_N"].to_list() == [1, 2, 1, 0, 1, 2, 0]
+
+    mapping, new_seq_list = larry.denoise_sequence(
+        seqs, whiteList=whiteList, distance_threshold=1, progress_bar=False
+    )
+    assert new_seq_list[2] == "CCCCCC"
+    assert new_seq_list[1] == "nan"
+
+    # the result does not depend on how the candidate pairs are chunked
+    whiteList = random_barcodes(300, 10, 300, error_rate=0)
+    seqs = random_barcodes(300, 10, 500, error_rate=0) + random_barcodes(30, 10, 500)
+    df = larry.match_whitelist(seqs, whiteList, distance_threshold=2)
+    for batch_size, max_pairs in [(7, 4000000), (100000, 1), (50, 100)]:
+        df_chunk = larry.match_whitelist(
+            seqs, whiteList, distance_threshold=2, batch_size=batch_size, max_pairs=max_pairs
+        )
+        assert df_chunk.equals(df)
+
+
+def LCS_length(x, y):
+    """
+    Reference: length of the longest common subsequence (the pairwise2 globalxx score), by dynamic programming
+    """
+    row = [0] * (len(y) + 1)
+    for a in x:
+        new_row = [0]
+        for j, b in enumerate(y):
+            new_row.append(row[j] + 1 if a == b else max(row[j + 1], new_row[j]))
+        row = new_row
+    return row[-1]
+
+
+def test_denoise_sequence_alignment():
+    true_list = ["".join(rng.choice(list("ACGT"), size=15)) for _ in range(5)]
+    seq_list = []
+    for _ in range(200):
+        seq = rng.choice(true_list)
+        if rng.random() < 0.3:
+            k = rng.integers(len(seq))
+            seq = seq[:k] + rng.choice(["", "A", "CG"]) + seq[k + rng.integers(0, 3) :]
+        seq_list.append(seq)
+    mapping, new_seq_list = larry.denoise_sequence(
+        seq_list, method="alignment", distance_threshold=2, progress_bar=False
+    )
+    # each merged sequence is close to its target by the globalxx score, and 10 fold less abundant
+    read = pd.Series(seq_list).value_counts()
+    for x, y in mapping.items():
+        x, y = x.decode(), y.decode()
+        if x != y:
+            score = LCS_length(x, y)
+            assert max(len(x), len(y)) - score <= 2
+            assert read[x] <= 0.1 * read[y]
+    assert set(new_seq_list).issubset(set(seq_list))
+
+
+def test_hamming_distance_bitplanes():
+    rng = np.random.default_rng(5)
+    for L, alphabet in [(16, b"ACGTN"), (70, b"ACGT"), (20, b"ACGT_0123456789")]:
+        X = rng.choice(np.frombuffer(alphabet, np.uint8), (30, L))
+        Y = rng.choice(np.frombuffer(alphabet, np.uint8), (20, L))
+        planes_X, planes_Y = util.pack_bitplanes(X, Y)
+        distance = util.hamming_distance_bitplanes(planes_X[:, None], planes_Y[None])
+        assert np.array_equal(distance, (X[:, None] != Y[None]).sum(-1))
+
+    seqs = ["".join(x) for x in rng.choice(list("ACGT"), (40, 12))]
+    for Kmer in [1, 3]:
+        kmers = np.array([larry.seq_partition(Kmer, x) for x in seqs])
+        expected = (kmers[:, None] != kmers[None]).sum(-1)
+        assert np.array_equal(larry.QC_sequence_distance(seqs, Kmer=Kmer), expected)
+
+
+def test_denoise_clonal_data_per_sample():
+    from concurrent.futures import ThreadPoolExecutor
+
+    df = pd.DataFrame(
+        {
+            "library": "lib1",
+            "cell_id": np.repeat([f"c{j}" for j in range(20)], 30),
+            "umi": [f"u{j}" for j in range(600)],
+            "clone_id": random_barcodes(10, 12, 600),
+            "read": rng.integers(1, 8, size=600),
+        }
+    )
+    df.loc[df["cell_id"] == "c3", "read"] = 1  # no molecule above the cutoff
+    kwargs = dict(
+        per_sample="cell_id", distance_threshold=1, plot_report=False, progress_bar=False
+    )
+    df_out = larry.denoise_clonal_data(df, **kwargs)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        df_out_1 = larry.denoise_clonal_data(df, n_jobs=2, executor=executor, **kwargs)
+    assert df_out.equals(df_out_1)
+    assert "c3" not in set(df_out["cell_id"])
+
+    # each cell is denoised on its own
+    for cell_id, df_cell in df[df["read"] >= 3].groupby("cell_id"):
+        mapping, new_seq_list = larry.denoise_sequence(
+            df_cell["clone_id"], read_count=df_cell["read"], distance_threshold=1, progress_bar=False
+        )
+        df_cell = df_cell.assign(clone_id=new_seq_list)
+        assert sorted(zip(df_cell["umi"], df_cell["clone_id"])) == sorted(
+            zip(*df_out[df_out["cell_id"] == cell_id][["umi", "clone_id"]].values.T)
+        )
+
+
+def test_denoise_clonal_data_packed():
+    df = pd.DataFrame(
+        {
+            "library": "lib1",
+            "cell_bc": np.repeat(random_barcodes(8, 16, 8, error_rate=0), 40),
+            "umi": random_barcodes(40, 12, 320),
+            "clone_id": random_barcodes(5, 12, 320),
+            "read": rng.integers(1, 8, size=320),
+        }
+    )
+    df = df.drop_duplicates(["cell_bc", "umi"])
+    df["cell_id"] = df["library"] + "_" + df["cell_bc"]
+    df_packed = larry.pack_barcodes(df)
+    kwargs = dict(
+        per_sample="cell_id", distance_threshold=1, plot_report=False, progress_bar=False
+    )
+    keys = ["library", "cell_bc", "umi", "clone_id", "read"]
+    for target_key in ["umi", "cell_bc"]:
+        df_out = larry.denoise_clonal_data(df, target_key=target_key, **kwargs)
+        df_out_packed = larry.denoise_clonal_data(df_packed, target_key=target_key, **kwargs)
+        assert pd.api.types.is_integer_dtype(df_out_packed[target_key])
+        df_out_packed = larry.unpack_barcodes(df_out_packed)
+        assert (df_out_packed["cell_id"] == df_out_packed["library"] + "_" + df_out_packed["cell_bc"]).all()
+        assert (
+            df_out[keys].sort_values(keys).reset_index(drop=True)
+        ).equals(df_out_packed[keys].sort_values(keys).reset_index(drop=True))
@@ -0,0 +1,104 @@
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pandas as pd
+
+from mosaiclineage import larry
+
+rng = np.random.default_rng(0)
+
+
+def random_seq(n):
+    return "".join(rng.choice(list("ACGT"), size=n))
+
+
+def write_LARRY_fastq(data_path, sample="S1", read_N=200):
+    """
+    Write a small LARRY fastq file: a '>sample,cell_bc,umi' header followed by the clone barcode,
+    with a few blank lines and malformed headers in between
+    """
+    cell_bc_list = [random_seq(8) for _ in range(5)]
+    clone_list = [random_seq(20) for _ in range(4)]
+    lines = []
+    for j in range(read_N):
+        if j % 17 == 0:
+            lines.append("")
+        if j % 23 == 0:
+            lines += [f">{sample},{rng.choice(cell_bc_list)}", random_seq(20)]
+        lines.append(f">{sample},{rng.choice(cell_bc_list)},{random_seq(2)}")
+        lines.append(rng.choice(clone_list))
+    with gzip.open(f"{data_path}/{sample}.LARRY.fastq.gz", "wt") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def test_LARRY_read_count_table_cache(tmp_path, capsys):
+    write_LARRY_fastq(tmp_path)
+    df = larry.generate_LARRY_read_count_table(tmp_path, ["S1"])
+    assert "Reading in library" in capsys.readouterr().out
+    assert os.path.exists(f"{tmp_path}/S1.LARRY.npz")
+
+    # reloaded from the cache, with the same columns and dtypes
+    df_cache = larry.generate_LARRY_read_count_table(tmp_path, ["S1"])
+    assert "Reading in library" not in capsys.readouterr().out
+    assert all(type(x) is str for x in df_cache.columns)
+    assert df_cache.columns.tolist() == df.columns.tolist()
+    assert (df_cache.dtypes == df.dtypes).all()
+    assert df_cache.equals(df)
+
+    # rebuilt once the fastq file changes
+    fastq_file_name = f"{tmp_path}/S1.LARRY.fastq.gz"
+    stat = os.stat(fastq_file_name)
+    os.utime(fastq_file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    larry.generate_LARRY_read_count_table(tmp_path, ["S1"])
+    assert "Reading in library" in capsys.readouterr().out
+
+    write_LARRY_fastq(tmp_path, read_N=300)
+    df_new = larry.generate_LARRY_read_count_table(tmp_path, ["S1"])
+    assert "Reading in library" in capsys.readouterr().out
+    assert df_new["read"].sum() > df["read"].sum()
+
+
+def count_LARRY_lines_by_line(lines):
+    """
+    Reference: the former per-line parser of generate_LARRY_read_count_table
+    """
+    counts = {}
+    current_tag = []
+    for x in lines:
+        l = x.decode("utf-8").strip("\n")
+        if l == "":
+            current_tag = []
+        elif l[0] == ">":
+            current_tag = l[1:].split(",")
+        elif l != "" and len(current_tag) == 3:
+            current_tag.append(l)
+            current_tag = tuple(current_tag)
+            counts[current_tag] = counts.get(current_tag, 0) + 1
+    return counts
+
+
+def test_count_LARRY_fastq(tmp_path):
+    write_LARRY_fastq(tmp_path)
+    file_name = f"{tmp_path}/S1.LARRY.fastq.gz"
+    with gzip.open(file_name, "rb") as f:
+        raw = f.read()
+    # also without the final newline
+    with gzip.open(f"{tmp_path}/S2.LARRY.fastq.gz", "wb") as f:
+        f.write(raw.rstrip(b"\n"))
+
+    for sample in ["S1", "S2"]:
+        with gzip.open(f"{tmp_path}/{sample}.LARRY.fastq.gz", "rb") as f:
+            expected = count_LARRY_lines_by_line(f.readlines())
+        for block_size in [1, 7, 64, 2**20]:
+            counts = larry.count_LARRY_fastq(
+                f"{tmp_path}/{sample}.LARRY.fastq.gz", block_size=block_size
+            )
+            counts = {
+                tuple(k[0][1:].decode().split(",")) + (k[1].decode(),): v
+                for k, v in counts.items()
+            }
+            assert counts == expected